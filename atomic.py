@@ -0,0 +1,28 @@
+#!/usr/bin/env python
+
+import os
+import tempfile
+from contextlib import contextmanager
+
+UMASK = os.umask(0)     # it can only be read by setting it, so it's read once on import
+os.umask(UMASK)
+
+# gives a temporary path next to path to write to, which replaces path once everything's written
+# a failed write never leaves half a file behind, and the file keeps the permissions of the one it replaces, or gets those of any new file
+@contextmanager
+def replacing(path):
+    f = tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(path)), prefix=".", suffix=os.path.splitext(path)[1], delete=False)
+    f.close()
+    try:
+        yield f.name
+        
+        try:
+            mode = os.stat(path).st_mode & 0o7777
+        except FileNotFoundError:
+            mode = 0o666 & ~UMASK
+        os.chmod(f.name, mode)
+        os.replace(f.name, path)
+    except BaseException:
+        if os.path.exists(f.name):
+            os.remove(f.name)
+        raise
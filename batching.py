@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# runs tasks of (name, function, arguments) on a pool of worker processes, printing each as it finishes then a summary
+# a task that fails is reported and the rest carry on, what a task returns is shown after its name unless it's None
+# on_done is called in this process with the name, result and seconds of every task that succeeds
+# returns the (name, exception) of every task that failed
+def run(tasks, jobs=None, verb="Processed", noun="files", per_minute=False, on_done=None):
+    failures = []
+    start = time.time()
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(timed, function, *arguments): name for name, function, arguments in tasks}
+        
+        for done, future in enumerate(as_completed(futures), 1):
+            name = futures[future]
+            try:
+                result, seconds = future.result()
+                made = f" -> '{result}'" if result is not None else ""
+                print(f"[{done}/{len(futures)}] '{name}'{made} ({seconds:.2f}s, {get_rate(done, time.time() - start, noun, per_minute)})")
+                if on_done:
+                    on_done(name, result, seconds)
+            except Exception as e:
+                failures += [(name, e)]
+                print(f"[{done}/{len(futures)}] FAILED '{name}': {type(e).__name__}: {e}")
+    
+    seconds = time.time() - start
+    print(f"\n{verb} {len(futures) - len(failures)} of {len(futures)} {noun} in {seconds:.1f}s ({get_rate(len(futures), seconds, noun, per_minute)})")
+    for name, e in failures:
+        print(f"\t'{name}': {type(e).__name__}: {e}")
+    return failures
+
+# runs in the worker, so the time is of the task alone and not of its wait in the queue
+def timed(function, *arguments):
+    start = time.time()
+    result = function(*arguments)
+    return result, time.time() - start
+
+def get_rate(done, seconds, noun, per_minute):
+    if per_minute:
+        return f"{done / max(seconds, 1e-9) * 60:.1f} {noun}/min"
+    return f"{done / max(seconds, 1e-9):.1f} {noun}/s"
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import math
+import time
+import argparse
+import platform
+import tempfile
+
+import numpy as np
+import soundfile as sf
+from mido import MidiFile, tempo2bpm
+
+import click_to_midi
+
+CLICK_SAMPLES = {1: "bar.wav", 4: "quarter.wav", 8: "eigth.wav", 16: "sixteenth.wav", 32: "thirtysecond.wav"}
+CLICKS_FOLDER = os.path.join(os.path.dirname(os.path.realpath(__file__)), "clicks")
+CLICK_SAMPLE_RATE = 44100   # rate the bundled clicks were rendered at
+TAIL = 1.0                  # seconds of silence after the last click
+MIN_GAP = 0.05              # min seconds between clicks, the bundled clicks are ~45ms long
+
+def main(output='',
+         seconds=300,
+         bpm_start=120,
+         bpm_end=120,
+         curve='linear',
+         numerators=[4],
+         divisions=[4],
+         meter_changes=0.0,
+         sample_rate=44100,
+         noise_floor=None,
+         detector='threshold',
+         repeat=3,
+         seed=0):
+
+    config = {k: v for k, v in locals().items() if k != 'output'}
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        click_paths = write_clicks(work_dir, sample_rate)
+        track_path = os.path.join(work_dir, "click.wav")
+        midi_path = os.path.join(work_dir, "click.mid")
+
+        print(f"Generating {seconds}s click track at {sample_rate}hz")
+        truth = generate_click_track(track_path, click_paths, seconds, bpm_start, bpm_end, curve,
+                                     numerators, divisions, meter_changes, sample_rate, noise_floor, seed)
+
+        stages = time_stages(track_path, midi_path, click_paths, detector, repeat)
+        errors = check_midi(midi_path, truth)
+
+    print_results(stages, errors)
+
+    if output:
+        results = {
+            "config": config,
+            "platform": {"python": platform.python_version(), "numpy": np.__version__, "machine": platform.machine()},
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "clicks": len(truth["samples"]),
+            "stages": stages,
+            "errors": errors,
+        }
+        with open(output, "w") as f:
+            json.dump(results, f, indent=4)
+        print(f"\nResults written to '{output}'")
+
+    return 1 if errors["failed"] else 0
+
+# the bundled clicks, resampled if the benchmark isn't at their sample rate
+def write_clicks(work_dir, sample_rate):
+    click_paths = {}
+    for division, name in CLICK_SAMPLES.items():
+        audio, sr = sf.read(os.path.join(CLICKS_FOLDER, name))
+        if sample_rate != sr:
+            positions = np.arange(round(len(audio) * sample_rate / sr)) * sr / sample_rate
+            audio = np.stack([np.interp(positions, np.arange(len(audio)), channel) for channel in np.atleast_2d(audio.T)], axis=1)
+
+        click_paths[division] = os.path.join(work_dir, name)
+        sf.write(click_paths[division], audio, sample_rate, subtype='PCM_24')
+    return click_paths
+
+# renders a click track following the rules in the README, and returns what create_midi should make of it
+def generate_click_track(path, click_paths, seconds, bpm_start, bpm_end, curve, numerators, divisions, meter_changes, sample_rate, noise_floor, seed):
+    rng = np.random.default_rng(seed)
+    clicks = {division: np.mean(np.atleast_2d(sf.read(p)[0].T), axis=0) for division, p in click_paths.items()}
+
+    samples = []
+    click_divisions = []
+    bars = []
+
+    position = 0.0
+    numerator, division = None, None
+    while position < seconds:
+        if numerator is None or rng.random() < meter_changes:
+            numerator, division = int(rng.choice(numerators)), int(rng.choice(divisions))
+
+        bars += [(numerator, division)]
+        for beat in range(numerator):
+            samples += [round(position * sample_rate)]
+            click_divisions += [1 if beat == 0 else division]
+
+            gap = 240 / (division * get_bpm(position / seconds, bpm_start, bpm_end, curve, rng))
+            if gap < MIN_GAP:
+                raise Exception(f"clicks {gap*1000:.1f}ms apart will overlap, slow down the tempo or use fewer subdivisions")
+            position += gap
+
+    # a final barline closes the last bar
+    samples += [round(position * sample_rate)]
+    click_divisions += [1]
+
+    audio = np.zeros(samples[-1] + len(clicks[1]) + round(TAIL * sample_rate))
+    for sample, division in zip(samples, click_divisions):
+        audio[sample:sample + len(clicks[division])] += clicks[division]
+
+    if noise_floor is not None:
+        audio += rng.normal(0, 10**(noise_floor / 20), len(audio))
+
+    sf.write(path, audio, sample_rate, subtype='PCM_24')
+
+    # the tempo create_midi works out from each gap
+    gaps = np.diff(samples)
+    note_divisions = np.repeat([division for _, division in bars], [numerator for numerator, _ in bars])
+    bpms = [round(bpm, 2) for bpm in ((4 / note_divisions) * 60 * sample_rate / gaps).tolist()]
+
+    return {"samples": samples, "bars": bars, "bpms": bpms}
+
+# tempo at a point 0-1 through the song
+def get_bpm(progress, bpm_start, bpm_end, curve, rng):
+    if curve == 'sine':
+        return bpm_start + (bpm_end - bpm_start) * (1 - math.cos(progress * 4 * math.pi)) / 2
+    elif curve == 'steps':
+        return rng.uniform(min(bpm_start, bpm_end), max(bpm_start, bpm_end))
+    return bpm_start + (bpm_end - bpm_start) * progress
+
+def time_stages(track_path, midi_path, click_paths, detector, repeat):
+    info = sf.info(track_path)
+    click_to_midi.configure(info.samplerate)
+
+    click_dicts = [{"division": division, "path": path} for division, path in click_paths.items()]
+    click_to_midi.init_click_dicts(click_dicts)
+
+    stages = {}
+
+    def stage(name, function, num_samples=None, num_clicks=None):
+        seconds = min(timed(function) for _ in range(repeat))
+        stages[name] = {
+            "seconds": seconds,
+            "samples_per_sec": num_samples / seconds if num_samples and seconds else None,
+            "clicks_per_sec": num_clicks / seconds if num_clicks and seconds else None,
+        }
+
+    audio = click_to_midi.prepare_audio(track_path)
+    stage("prepare_audio", lambda: click_to_midi.prepare_audio(track_path), len(audio))
+
+    if detector == 'matched':
+        click_arr = click_to_midi.match_click_arr(audio, click_dicts)
+        stage("match_click_arr", lambda: click_to_midi.match_click_arr(audio, click_dicts), len(audio), len(click_arr))
+    else:
+        click_arr = click_to_midi.create_click_arr(audio, click_dicts)
+        stage("create_click_arr", lambda: click_to_midi.create_click_arr(audio, click_dicts), len(audio), len(click_arr))
+
+    click_starts, click_ends = click_to_midi.find_click_bounds(audio)
+    stage("find_click_bounds", lambda: click_to_midi.find_click_bounds(audio), len(audio), len(click_starts))
+    stage("find_click_division", lambda: [click_to_midi.find_click_division(audio[s:e], click_dicts) for s, e in zip(click_starts, click_ends)],
+          None, len(click_starts))
+    stage("classify_clicks", lambda: click_to_midi.classify_clicks(audio, click_starts, click_ends, click_dicts), None, len(click_starts))
+    stage("create_midi", lambda: click_to_midi.create_midi(click_arr), None, len(click_arr))
+
+    click_options = {f"click_{name}": click_paths[division] for name, division in [("bar", 1), ("4th", 4), ("8th", 8), ("16th", 16), ("32nd", 32)]}
+    stage("end_to_end", lambda: click_to_midi.main(track_path, midi_path, detector=detector, **click_options), len(audio), len(click_arr))
+
+    return stages
+
+def timed(function):
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+# compares the midi against the generated tempo map, every click needs the right time signature and tempo
+def check_midi(midi_path, truth):
+    midi_file = MidiFile(midi_path)
+
+    tempo_events = []
+    sig_events = []
+    tick = 0
+    for message in midi_file.tracks[0]:
+        tick += message.time
+        if message.type == "set_tempo":
+            tempo_events += [(tick, tempo2bpm(message.tempo))]
+        elif message.type == "time_signature":
+            sig_events += [(tick, (message.numerator, message.denominator))]
+
+    note_ticks = []
+    tick = 0
+    for message in midi_file.tracks[1]:
+        tick += message.time
+        if message.type == "note_on":
+            note_ticks += [tick]
+
+    failed = []
+    if len(note_ticks) != len(truth["samples"]):
+        failed += [f"{len(note_ticks)} click notes, expected {len(truth['samples'])}"]
+
+    # tempo in effect on each click
+    tempo_ticks = [t for t, _ in tempo_events]
+    max_bpm_error = 0.0
+    for i, (tick, bpm) in enumerate(zip(note_ticks, truth["bpms"])):
+        event = np.searchsorted(tempo_ticks, tick, side='right') - 1
+        error = abs(tempo_events[event][1] - bpm) if event >= 0 else math.inf
+        max_bpm_error = max(max_bpm_error, error)
+        if error > click_to_midi.BPM_TOL + 0.01:
+            failed += [f"click {i} is {tempo_events[event][1] if event >= 0 else None}bpm, expected {bpm}bpm"]
+            break
+
+    # time signature in effect on each bar
+    sig_ticks = [t for t, _ in sig_events]
+    bar_ticks = np.array(note_ticks)[np.cumsum([0] + [numerator for numerator, _ in truth["bars"]][:-1])] if len(note_ticks) == len(truth["samples"]) else []
+    for i, (tick, sig) in enumerate(zip(bar_ticks, truth["bars"])):
+        event = np.searchsorted(sig_ticks, tick, side='right') - 1
+        if event < 0 or sig_events[event][1] != sig:
+            failed += [f"bar {i} is {sig_events[event][1] if event >= 0 else None}, expected {sig}"]
+            break
+
+    return {"max_bpm_error": max_bpm_error, "failed": failed}
+
+def print_results(stages, errors):
+    print(f"\n{'stage':<22}{'seconds':>10}{'samples/sec':>16}{'clicks/sec':>14}")
+    for name, result in stages.items():
+        samples_per_sec = f"{result['samples_per_sec']:,.0f}" if result['samples_per_sec'] else "-"
+        clicks_per_sec = f"{result['clicks_per_sec']:,.0f}" if result['clicks_per_sec'] else "-"
+        print(f"{name:<22}{result['seconds']:>10.3f}{samples_per_sec:>16}{clicks_per_sec:>14}")
+
+    print(f"\nMax BPM error: {errors['max_bpm_error']:.3f}")
+    for failure in errors["failed"]:
+        print(f"FAILED: {failure}")
+    if not errors["failed"]:
+        print("MIDI matches the generated tempo map")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='A tool for benchmarking click_to_midi against generated click tracks with a known tempo map')
+    parser.add_argument('-o', '--output', default='', help='A json file to save the results to, for comparing between versions')
+    parser.add_argument('-s', '--seconds', type=float, default=300, help='Length of the generated click track')
+    parser.add_argument('-b', '--bpm', type=float, nargs=2, default=[120, 120], metavar=('START', 'END'), help='Tempo range of the click track')
+    parser.add_argument('-c', '--curve', choices=['linear', 'sine', 'steps'], default='linear', help='How the tempo moves between the start and end bpm, steps picks a new tempo every click')
+    parser.add_argument('-n', '--numerators', type=int, nargs='+', default=[4], help='Beats per bar to choose from')
+    parser.add_argument('-d', '--divisions', type=int, nargs='+', default=[4], choices=[4, 8, 16, 32], help='Subdivisions to choose from')
+    parser.add_argument('-m', '--meter_changes', type=float, default=0.0, help='Chance from 0-1 of each bar changing time signature')
+    parser.add_argument('-sr', '--sample_rate', type=int, default=44100, help='Sample rate of the click track')
+    parser.add_argument('-nf', '--noise_floor', type=float, default=None, help='Level in dBFS of noise added to the click track')
+    parser.add_argument('-det', '--detector', choices=['threshold', 'matched'], default='threshold', help='click_to_midi detector to benchmark')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Times to run each stage, the fastest is kept')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the meter changes, stepped tempos and noise')
+
+    args = vars(parser.parse_args())
+
+    sys.exit(main(
+        args['output'],
+        args['seconds'],
+        args['bpm'][0],
+        args['bpm'][1],
+        args['curve'],
+        args['numerators'],
+        args['divisions'],
+        args['meter_changes'],
+        args['sample_rate'],
+        args['noise_floor'],
+        args['detector'],
+        args['repeat'],
+        args['seed'],
+    ))
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+
+import numpy as np
+from PIL import Image, ImageFilter, ImageDraw
+
+import folder_gen
+
+MIN_PSNR = 30.0     # min dB the album and background can differ from the full resolution reference by
+
+def main(output='',
+         sizes=[6000],
+         aspect_ratio=1.0,
+         formats=['jpg', 'png'],
+         repeat=3,
+         seed=0):
+
+    config = {k: v for k, v in locals().items() if k != 'output'}
+
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        for size in sizes:
+            for ext in formats:
+                cover_path = os.path.join(work_dir, f"cover_{size}.{ext}")
+                print(f"Generating {size}px {ext} cover")
+                generate_cover(cover_path, (size, int(size / aspect_ratio)), seed)
+                results += [time_cover(cover_path, work_dir, size, ext, repeat)]
+
+    print_results(results)
+
+    if output:
+        with open(output, "w") as f:
+            json.dump({
+                "config": config,
+                "platform": {"python": platform.python_version(), "pillow": Image.__version__, "machine": platform.machine()},
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "results": results,
+            }, f, indent=4)
+        print(f"\nResults written to '{output}'")
+
+    return 1 if any(result["failed"] for result in results) else 0
+
+# smooth colour with some sharp edges and fine noise, so both the blur and the scaling show up in the comparison
+def generate_cover(path, size, seed):
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:size[1], 0:size[0]].astype(np.float32)
+    pixels = np.stack([
+        128 + 127 * np.sin(x / size[0] * 6 + y / size[1] * 2),
+        128 + 127 * np.cos(y / size[1] * 5),
+        128 + 127 * np.sin((x + y) / max(size) * 9),
+    ], axis=-1)
+    pixels += rng.normal(0, 12, pixels.shape).astype(np.float32)
+    image = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+
+    draw = ImageDraw.Draw(image)
+    for _ in range(40):
+        x1, y1 = rng.integers(0, size[0]), rng.integers(0, size[1])
+        draw.rectangle([x1, y1, x1 + size[0] // 10, y1 + size[1] // 10], fill=tuple(int(c) for c in rng.integers(0, 256, 3)))
+    image.save(path, quality=95)
+
+def time_cover(cover_path, work_dir, size, ext, repeat):
+    reference = {base: os.path.join(work_dir, f"reference_{base}.png") for base in ["album", "background"]}
+    rendered = {base: os.path.join(work_dir, f"{base}.png") for base in ["album", "background"]}
+
+    reference_seconds = min(timed(lambda: render_reference(cover_path, reference)) for _ in range(repeat))
+    seconds = min(timed(lambda: render(cover_path, rendered)) for _ in range(repeat))
+
+    psnrs = {base: get_psnr(reference[base], rendered[base]) for base in reference}
+    return {
+        "size": size,
+        "format": ext,
+        "reference_seconds": reference_seconds,
+        "seconds": seconds,
+        "psnr": psnrs,
+        "failed": [f"{base} is {psnr:.1f}dB from the reference" for base, psnr in psnrs.items() if psnr < MIN_PSNR],
+    }
+
+def render(cover_path, image_outs):
+    cover, full_size = folder_gen.load_cover(cover_path, list(image_outs))
+    folder_gen.create_album(cover, full_size, image_outs["album"])
+    folder_gen.create_background(cover, full_size, image_outs["background"])
+
+# the album and background the way they were made before, each from its own full resolution decode
+def render_reference(cover_path, image_outs):
+    image = Image.open(cover_path)
+    if(image.width > min(folder_gen.MAX_RESOLUTION) or image.height > min(folder_gen.MAX_RESOLUTION)):
+        image = image.resize((min(folder_gen.MAX_RESOLUTION), min(folder_gen.MAX_RESOLUTION)))
+    image.save(image_outs["album"], 'png')
+
+    image = Image.open(cover_path)
+    (width, height), _ = folder_gen.get_background_size(image.size)
+    resized_image = image.resize((width, width))
+    top = (width - height) / 2
+    blurred_image = resized_image.crop((0, top, width, top + height)).filter(ImageFilter.GaussianBlur(radius=folder_gen.BLUR_RADIUS))
+
+    cover_image = image.resize((int(image.width*0.5), int(image.height*0.5)))
+    pos_x = int((width - cover_image.width) / 2)
+    pos_y = int((height - cover_image.height) / 2) - int(height*0.2)
+    border_size = int(width * 0.0015)
+    ImageDraw.Draw(blurred_image).rectangle([pos_x - border_size, pos_y - border_size,
+                                             pos_x + cover_image.width + border_size, pos_y + cover_image.height + border_size], fill=(0, 0, 0))
+    blurred_image.paste(cover_image, (pos_x, pos_y))
+
+    if(blurred_image.width > folder_gen.MAX_RESOLUTION[0]):
+        blurred_image = blurred_image.resize(folder_gen.MAX_RESOLUTION)
+    blurred_image.save(image_outs["background"], 'png')
+
+def timed(function):
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+def get_psnr(reference_path, path):
+    reference = np.asarray(Image.open(reference_path).convert("RGB"), dtype=np.float64)
+    image = np.asarray(Image.open(path).convert("RGB"), dtype=np.float64)
+    if reference.shape != image.shape:
+        return 0.0
+    mse = np.mean(np.square(reference - image))
+    return 10 * np.log10(255**2 / mse) if mse else np.inf
+
+def print_results(results):
+    print(f"\n{'cover':<14}{'reference s':>12}{'seconds':>10}{'speedup':>10}{'album dB':>10}{'bg dB':>10}")
+    for result in results:
+        name = f"{result['size']}px {result['format']}"
+        speedup = result['reference_seconds'] / result['seconds']
+        print(f"{name:<14}{result['reference_seconds']:>12.3f}{result['seconds']:>10.3f}{speedup:>9.1f}x"
+              f"{result['psnr']['album']:>10.1f}{result['psnr']['background']:>10.1f}")
+
+    failures = [f"{result['size']}px {result['format']} {failure}" for result in results for failure in result["failed"]]
+    for failure in failures:
+        print(f"FAILED: {failure}")
+    if not failures:
+        print(f"\nEvery album and background is within {MIN_PSNR:.0f}dB PSNR of the reference")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='A tool for benchmarking the album and background folder_gen renders from large generated covers')
+    parser.add_argument('-o', '--output', default='', help='A json file to save the results to, for comparing between versions')
+    parser.add_argument('-s', '--sizes', type=int, nargs='+', default=[6000], help='Widths of the generated covers')
+    parser.add_argument('-a', '--aspect_ratio', type=float, default=1.0, help='Width over height of the generated covers')
+    parser.add_argument('-f', '--formats', nargs='+', default=['jpg', 'png'], choices=['jpg', 'png'], help='Image formats to save the covers as')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Times to render each cover, the fastest is kept')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the cover noise and shapes')
+
+    args = vars(parser.parse_args())
+
+    sys.exit(main(
+        args['output'],
+        args['sizes'],
+        args['aspect_ratio'],
+        args['formats'],
+        args['repeat'],
+        args['seed'],
+    ))
@@ -2,65 +2,177 @@
 
 import os
 import sys
-from time import time
 
-from mido import MidiFile, MidiTrack, Message, MetaMessage
- 
- 
-def main(in_file, out_file, purge_list):
+import numpy as np
+from mido import MidiFile
+
+import chart
+import batching
+import profiler
+
+STAR_POWER_NOTE = 116
+DIFFICULTY_NOTES = {            # note ranges of each difficulty, expert starts at 95 for the expert+ kick
+    "easy": (60, 72),
+    "medium": (72, 84),
+    "hard": (84, 95),
+    "expert": (95, 108),
+}
+TEXT_TYPES = ["text", "lyrics"]
+CHART_NAME = "notes.mid"    # what batch mode looks for in a library
+
+# transforms is a list of (name, arguments) from TRANSFORMS, they're all applied to every part in one pass
+def main(in_file, out_file, transforms):
     
-    midi_file = MidiFile(in_file, type=1)
+    with profiler.stage("chart load"):
+        midi_file = MidiFile(in_file, type=1)
+        tracks = chart.load_midi(midi_file)
     
-    parts = [part for part in midi_file.tracks if "PART " in part.name]
-    for part in parts:
-        if "star_power" in purge_list:
-            purge_note_messages(part, note=116)
-
+    pipeline = [TRANSFORMS[name](*arguments) for name, arguments in transforms]
+    
+    parts = [track for track in tracks if "PART " in chart.get_track_name(track)]
+    with profiler.stage("transforms"):
+        for part in parts:
+            apply_transforms(part, pipeline)
 
     # write file
-    with open(out_file, "wb") as f:
-        midi_file.save(file=f)
+    with profiler.stage("chart write"):
+        chart.save_midi_file(out_file, tracks, midi_file.ticks_per_beat)
 
-def purge_messages_of_type(track, types):
-    indices = []
-    for i, message in enumerate(track):
-         if message.type in types:
-            indices += [i]
-            track[i+1].time += message.time
+# applies the transforms to every chart in a library, spread over a pool of worker processes
+# charts are edited in place unless there's an output folder, then they're written to the same place under it
+# a chart that fails is reported and the rest carry on
+def batch(root, output_root='', transforms=(), jobs=None):
+    tasks = []
+    for in_file in find_charts(root):
+        out_file = os.path.join(output_root, os.path.relpath(in_file, root)) if output_root else in_file
+        tasks += [(in_file, convert_file, (in_file, out_file, transforms))]
+    
+    failures = batching.run(tasks, jobs, "Processed", "charts")
+    return 1 if failures else 0
 
-    for i in reversed(indices):
-        track.pop(i)
+def convert_file(in_file, out_file, transforms):
+    os.makedirs(os.path.dirname(os.path.abspath(out_file)), exist_ok=True)
+    main(in_file, out_file, transforms)
 
-def purge_note_messages(track, note=None, velocity=None):
-    assert note or velocity
-    
-    indices = []
-    for i, message in enumerate(track):
-        if message.type in ["note_on", "note_off"]:
-            if (note == None or message.note == note) and \
-               (velocity == None or message.velocity == velocity): 
-                indices += [i]
-                track[i+1].time += message.time
+def find_charts(root):
+    in_files = []
+    for folder, _, files in os.walk(root):
+        in_files += [os.path.join(folder, f) for f in files if f.lower() == CHART_NAME]
+    return sorted(in_files)
+
+# TRANSFORMS
+# each makes a dict of what it does to a part, any of
+#   "drop_notes": a function of the notes array giving a mask of the notes to drop
+#   "map_notes": an array of the new number of every note number
+#   "velocity": a velocity every note on is set to
+#   "drop_events": a function of an event's message, true to drop it
+
+def remove_star_power():
+    return {"drop_notes": lambda notes: notes["note"] == STAR_POWER_NOTE}
 
-    for i in reversed(indices):
-        track.pop(i)
+def remove_difficulty(difficulty):
+    low, high = DIFFICULTY_NOTES[difficulty]
+    return {"drop_notes": lambda notes: (notes["note"] >= low) & (notes["note"] < high)}
+
+def remap_notes(mapping):
+    note_map = np.arange(128, dtype=np.uint8)
+    for old_note, new_note in mapping.items():
+        if not (0 <= old_note <= 127 and 0 <= new_note <= 127):
+            raise Exception(f"notes must be from 0 to 127, not {old_note}:{new_note}")
+        note_map[old_note] = new_note
+    return {"map_notes": note_map}
+
+def remove_text():
+    return {"drop_events": lambda message: message.type in TEXT_TYPES}
+
+# a note on of velocity 0 is a note off, so those are left alone along with note offs, and 0 can't be set for the same reason
+def set_velocity(velocity):
+    if not 1 <= velocity <= 127:
+        raise Exception(f"velocity must be from 1 to 127, not {velocity}")
+    return {"velocity": velocity}
+
+TRANSFORMS = {
+    "star_power": remove_star_power,
+    "difficulty": remove_difficulty,
+    "remap": remap_notes,
+    "text": remove_text,
+    "velocity": set_velocity,
+}
+
+# fuses the transforms into one pass over the notes and one over the events
+# each transform sees the notes as the ones before it left them
+def apply_transforms(part, pipeline):
+    notes = part["notes"].copy()
+    kept = np.ones(len(notes), dtype=bool)
+    
+    for transform in pipeline:
+        if "drop_notes" in transform:
+            kept &= ~transform["drop_notes"](notes)
+        if "map_notes" in transform:
+            notes["note"] = transform["map_notes"][notes["note"]]
+        if "velocity" in transform:
+            note_ons = (notes["type"] == chart.NOTE_TYPES.index("note_on")) & (notes["velocity"] > 0)
+            notes["velocity"] = np.where(note_ons, transform["velocity"], notes["velocity"])
+    
+    part["notes"] = notes[kept]
+    profiler.count("messages removed", int(len(kept) - kept.sum()))
+    
+    drop_events = [transform["drop_events"] for transform in pipeline if "drop_events" in transform]
+    if drop_events:
+        events = part["events"]
+        part["events"] = [event for event in events if not any(drop(event[2]) for drop in drop_events)]
+        profiler.count("messages removed", len(events) - len(part["events"]))
 
 if __name__ == '__main__':
     import argparse
     
     parser = argparse.ArgumentParser(description='A tool for adjusting aspects of a multitrack midi file for use with Clone Hero')
-    parser.add_argument('-i', '--input', required=True, help='A multitrack midi file with all parts')
-    parser.add_argument('-o', '--output', default='', help='An output midi file of all parts combined')
+    parser.add_argument('-i', '--input', required=True, help='A multitrack midi file with all parts, or a library folder to edit every notes.mid in')
+    parser.add_argument('-o', '--output', default='', help='An output midi file of all parts combined, or an output folder for a library')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='Number of charts to edit at once in a library, defaults to the number of cores')
     parser.add_argument('--nosp', action='store_true', help='Remove star power gems from all parts of the chart')
+    parser.add_argument('--nodiff', nargs='+', default=[], choices=list(DIFFICULTY_NOTES), help='Remove every note of these difficulties from all parts of the chart')
+    parser.add_argument('--remap', nargs='+', default=[], metavar='OLD:NEW', help='Move every OLD note number to NEW in all parts of the chart')
+    parser.add_argument('--notext', action='store_true', help='Remove text and lyric events from all parts of the chart')
+    parser.add_argument('--velocity', type=int, default=None, help='Set every note on in all parts of the chart to this velocity, from 1 to 127')
+    parser.add_argument('--profile', nargs='?', const='', default=None, metavar='JSON', help='Print the time and peak memory of each stage with some counters, and optionally save them to a json file')
     
     args = vars(parser.parse_args())
+    remap = {}
+    for pair in args['remap']:
+        notes = pair.split(":")
+        if len(notes) != 2 or not all(note.strip().isdigit() for note in notes):
+            parser.error(f"argument --remap: pairs must be OLD:NEW note numbers, not '{pair}'")
+        old_note, new_note = int(notes[0]), int(notes[1])
+        if old_note > 127 or new_note > 127:
+            parser.error(f"argument --remap: notes must be from 0 to 127, not '{pair}'")
+        remap[old_note] = new_note
+    if args['velocity'] is not None and not 1 <= args['velocity'] <= 127:
+        parser.error(f"argument --velocity: must be from 1 to 127, not {args['velocity']}")
+    if args['profile'] is not None:
+        profiler.enable()
 
     in_file =  args['input']
     out_file =  args['output'] if args['output'] != '' else args['input']
     
-    purge_list = []
+    # applied in the order they're listed here
+    transforms = []
+    if remap:
+        transforms += [("remap", [remap])]
     if(args['nosp']):
-        purge_list += ["star_power"]
+        transforms += [("star_power", [])]
+    for difficulty in args['nodiff']:
+        transforms += [("difficulty", [difficulty])]
+    if args['notext']:
+        transforms += [("text", [])]
+    if args['velocity'] is not None:
+        transforms += [("velocity", [args['velocity']])]
     
-    sys.exit(main(in_file, out_file, purge_list))
+    if os.path.isdir(in_file):
+        result = batch(in_file, args['output'], transforms, args['jobs'])
+    else:
+        result = main(in_file, out_file, transforms)
+    if args['profile'] is not None:
+        profiler.report(args['profile'])
+    sys.exit(result)
 
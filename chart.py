@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+import numpy as np
+from mido import MidiFile, MidiTrack, Message, MetaMessage
+
+import smf
+import atomic
+import profiler
+
+NOTE_TYPES = ["note_off", "note_on"]    # stored by their index here
+
+# a note is a row of this, everything else is an event in a side table of (tick, order, message)
+# ticks are absolute, order is the position the message was loaded from, and breaks ties between messages on the same tick
+NOTE_DTYPE = np.dtype([
+    ("tick", np.int64),
+    ("order", np.int64),
+    ("type", np.uint8),
+    ("channel", np.uint8),
+    ("note", np.uint8),
+    ("velocity", np.uint8),
+])
+
+# a chart track is a dict of its "notes" as a NOTE_DTYPE array and the "events" side table
+def load_track(track):
+    notes = []
+    events = []
+    tick = 0
+    for order, message in enumerate(track):
+        tick += message.time
+        if message.type in NOTE_TYPES:
+            notes += [(tick, order, NOTE_TYPES.index(message.type), message.channel, message.note, message.velocity)]
+        else:
+            events += [(tick, order, message)]
+
+    return {"notes": np.array(notes, dtype=NOTE_DTYPE), "events": events}
+
+def load_midi(midi_file):
+    return [load_track(track) for track in midi_file.tracks]
+
+# the order messages are written in, as indices into the notes then the events, and their ticks
+# messages on the same tick keep their order, and anything added after loading goes after what it copied the order of
+def get_sequence(chart_track):
+    notes = chart_track["notes"]
+    events = chart_track["events"]
+
+    ticks = np.concatenate((notes["tick"], np.array([tick for tick, _, _ in events], dtype=np.int64)))
+    orders = np.concatenate((notes["order"], np.array([order for _, order, _ in events], dtype=np.int64)))
+    sequence = np.lexsort((orders, ticks))
+    return sequence.tolist(), ticks[sequence].tolist()
+
+def to_track(chart_track):
+    notes = chart_track["notes"]
+    events = chart_track["events"]
+    sequence, ticks = get_sequence(chart_track)
+
+    note_rows = notes[["type", "channel", "note", "velocity"]].tolist()
+    track = MidiTrack()
+    previous_tick = 0
+    for i, tick in zip(sequence, ticks):
+        if i < len(note_rows):
+            note_type, channel, note, velocity = note_rows[i]
+            track.append(Message(NOTE_TYPES[note_type], channel=channel, note=note, velocity=velocity, time=tick - previous_tick))
+        else:
+            track.append(events[i - len(note_rows)][2].copy(time=tick - previous_tick))
+        previous_tick = tick
+    return track
+
+def to_midi_file(chart_tracks, ticks_per_beat):
+    midi_file = MidiFile(type=1, ticks_per_beat=ticks_per_beat)
+    midi_file.tracks += [to_track(chart_track) for chart_track in chart_tracks]
+    return midi_file
+
+# writes the same bytes as saving a MidiFile of to_track, without making a Message for every note
+def save_midi(file, chart_tracks, ticks_per_beat):
+    file.write(smf.write_header(len(chart_tracks), ticks_per_beat))
+    for chart_track in chart_tracks:
+        file.write(smf.write_track_chunk(encode_track(chart_track)))
+
+# written to a temporary file next to the path first, so a failed save never leaves half a chart behind
+def save_midi_file(path, chart_tracks, ticks_per_beat):
+    with atomic.replacing(path) as temp_path:
+        with open(temp_path, "wb") as f:
+            save_midi(f, chart_tracks, ticks_per_beat)
+
+# channel messages use running status like mido, and any end_of_track is replaced by one after the last message
+def encode_track(chart_track):
+    notes = chart_track["notes"]
+    events = chart_track["events"]
+    sequence, ticks = get_sequence(chart_track)
+
+    note_rows = notes[["type", "channel", "note", "velocity"]].tolist()
+    note_statuses = [0x80, 0x90]
+
+    data = bytearray()
+    previous_tick = 0
+    running_status = None
+    for i, tick in zip(sequence, ticks):
+        if i < len(note_rows):
+            note_type, channel, note, velocity = note_rows[i]
+            message_bytes = bytes([note_statuses[note_type] | channel, note, velocity])
+        else:
+            message = events[i - len(note_rows)][2]
+            if message.type == "end_of_track":
+                continue
+            elif message.is_meta:
+                message_bytes = bytes(message.bytes())
+            elif message.type == "sysex":
+                message_bytes = bytes([0xF0]) + smf.write_var_length(len(message.data) + 1) + bytes(message.data) + bytes([0xF7])
+            else:
+                message_bytes = bytes(message.bytes())
+
+        data += smf.write_var_length(tick - previous_tick)
+        previous_tick = tick
+        if message_bytes[0] == running_status:
+            data += message_bytes[1:]
+        else:
+            data += message_bytes
+        running_status = message_bytes[0] if message_bytes[0] < 0xF0 else None
+
+    end_tick = max(ticks, default=0)
+    data += smf.write_var_length(end_tick - previous_tick) + b"\xff\x2f\x00"
+    return bytes(data)
+
+def get_track_name(chart_track):
+    names = [(tick, order, message.name) for tick, order, message in chart_track["events"] if message.type == "track_name"]
+    return min(names)[2] if names else ""
+
+# message types in the order they first appear
+def get_message_types(chart_track):
+    notes = chart_track["notes"]
+    events = chart_track["events"]
+    sequence, _ = get_sequence(chart_track)
+
+    types = {}
+    for i in sequence:
+        types.setdefault(NOTE_TYPES[notes["type"][i]] if i < len(notes) else events[i - len(notes)][2].type, None)
+    return list(types)
+
+# rounds to the nearest new tick, in absolute time so rounding never builds up along a track
+def rescale_ticks(ticks, old_ticks_per_beat, new_ticks_per_beat):
+    return (np.asarray(ticks, dtype=np.int64) * new_ticks_per_beat * 2 + old_ticks_per_beat) // (old_ticks_per_beat * 2)
+
+def rescale_track(chart_track, old_ticks_per_beat, new_ticks_per_beat):
+    notes = chart_track["notes"]
+    events = chart_track["events"]
+
+    notes["tick"] = rescale_ticks(notes["tick"], old_ticks_per_beat, new_ticks_per_beat)
+    event_ticks = rescale_ticks([tick for tick, _, _ in events], old_ticks_per_beat, new_ticks_per_beat).tolist()
+    chart_track["events"] = [(tick, order, message) for tick, (_, order, message) in zip(event_ticks, events)]
+    profiler.count("messages retimed", len(notes) + len(events))
+
+def purge_events(chart_track, types):
+    events = chart_track["events"]
+    chart_track["events"] = [event for event in events if event[2].type not in types]
+    profiler.count("messages removed", len(events) - len(chart_track["events"]))
+
+# new notes go after the notes they share a tick and order with
+def add_notes(chart_track, notes):
+    chart_track["notes"] = np.concatenate((chart_track["notes"], notes))
+    profiler.count("messages added", len(notes))
+
+def add_event(chart_track, tick, order, message):
+    chart_track["events"] += [(tick, order, message)]
+    profiler.count("messages added")
+
+# renames the first track_name event, or gives the track one
+def set_track_name(chart_track, name):
+    events = chart_track["events"]
+    track_names = [i for i, (_, _, message) in enumerate(events) if message.type == "track_name"]
+    if track_names:
+        i = min(track_names, key=lambda i: events[i][:2])
+        tick, order, message = events[i]
+        events[i] = (tick, order, message.copy(name=name))
+    else:
+        events.insert(0, (0, -1, MetaMessage('track_name', name=name, time=0)))
@@ -4,114 +4,88 @@ import os
 import sys
 from time import time
 
-from mido import MidiFile, MidiTrack, Message, MetaMessage
+import numpy as np
+from mido import MidiFile, MetaMessage
+
+import chart
+import profiler
  
 PART_TYPES = ["BEAT", "PART DRUMS", "EVENTS"]
 TICKS_PER_BEAT = 480        # somewhat arbitrary, but everything needs to convert to a single tpb
 TOM_NOTES = [110, 111, 112] # drop -12 pitch to add tom notes to expert
 SECTION_NOTE = 0
 
+# each of in_files is a path to a midi file, or a (name, MidiFile) pair of one already in memory
+# the part is whichever of PART_TYPES is in the file name
 def main(in_files, out_file):
     
     # Load up all midi files
     part_dict = {}
-    for in_file in in_files:
-        basename = os.path.splitext(os.path.basename(in_file))[0]
-        for part in PART_TYPES:
-            if part in basename:
-                part_dict[part] = MidiFile(in_file, type=1)
-                break
+    with profiler.stage("chart load"):
+        for in_file in in_files:
+            name, midi_file = in_file if isinstance(in_file, tuple) else (in_file, None)
+            basename = os.path.splitext(os.path.basename(name))[0]
+            for part in PART_TYPES:
+                if part in basename:
+                    part_dict[part] = midi_file if midi_file is not None else MidiFile(name, type=1)
+                    break
     
-    out_midi = MidiFile()
+    out_tracks = []
     
     # append each track
     for part, midi_file in part_dict.items():
         
-        adjust_message_timings(midi_file, TICKS_PER_BEAT)
-            
-        track = midi_file.tracks[0]
+        with profiler.stage("timing conversion"):
+            track = chart.load_track(midi_file.tracks[0])
+            chart.rescale_track(track, midi_file.ticks_per_beat, TICKS_PER_BEAT)
         
         if "BEAT" in part:
-            out_midi.tracks.insert(0, midi_file.tracks[0])
+            out_tracks.insert(0, track)
             continue
         elif "DRUM"in part:
-            adjust_drums(track)
+            with profiler.stage("drum adjustment"):
+                adjust_drums(track)
         elif "EVENTS" in part:
-            track = create_events(track)
+            with profiler.stage("event creation"):
+                track = create_events(track)
             
-        track[0].name = part
-        out_midi.tracks.append(track)
-                
-    print_midi(out_midi)
+        chart.set_track_name(track, part)
+        out_tracks.append(track)
+    
+    print_midi(out_tracks, TICKS_PER_BEAT)
 
     # write file
-    with open(out_file, "wb") as f:
-        out_midi.save(file=f)
-
-def purge_messages_of_type(track, types):
-    indices = []
-    for i, message in enumerate(track):
-         if message.type in types:
-            indices += [i]
-            track[i+1].time += message.time
-
-    for i in reversed(indices):
-        track.pop(i)
-
-def adjust_message_timings(midi_file, new_ticks_per_beat):
-    multiplier = new_ticks_per_beat / midi_file.ticks_per_beat
-    
-    for track in midi_file.tracks:
-        for message in track:
-            message.time = int(message.time * multiplier)
+    with profiler.stage("chart write"):
+        with open(out_file, "wb") as f:
+            chart.save_midi(f, out_tracks, TICKS_PER_BEAT)
 
 def adjust_drums(track):
-    track.insert(1, MetaMessage('text', text=f'ENABLE_CHART_DYNAMICS', time=0))
-    purge_messages_of_type(track, ['time_signature'])
+    chart.add_event(track, 0, 0, MetaMessage('text', text=f'ENABLE_CHART_DYNAMICS', time=0))
+    chart.purge_events(track, ['time_signature'])
     add_toms(track)
 
+# every tom marker note gets a copy an octave down, straight after it
 def add_toms(track):
-    types = ["note_on", "note_off"]
-
-    indices = []
-    for i, message in enumerate(track):
-         if message.type in types and message.note in TOM_NOTES:
-            indices += [(i, message)]
-            
-    for (i, msg) in reversed(indices):
-        track.insert(i+1, (Message(msg.type, note=msg.note-12, velocity=msg.velocity, time=0)))
+    toms = track["notes"][np.isin(track["notes"]["note"], TOM_NOTES)]
+    toms["note"] -= 12
+    chart.add_notes(track, toms)
 
+# a section starts on every note
 def create_events(track):
-    out_track = MidiTrack()
-    out_track.append(MetaMessage('track_name', name='EVENTS', time=0))
+    notes = track["notes"]
+    section_ticks = notes["tick"][notes["type"] == chart.NOTE_TYPES.index("note_on")].tolist()
     
-    _time = 0
-    section_number = 1
-    for i, message in enumerate(track):
-        if message.type == "note_on":
-            sect_time = message.time + _time
-            _time = 0
-            out_track.append(
-                MetaMessage('text', text=f'[section Section {section_number}]', time=sect_time)
-            )
-            
-            section_number += 1
-            
-        elif message.type == "note_off":
-            _time = message.time
-            
-    out_track.append(MetaMessage('end_of_track', time=0))
-    return out_track
+    events = [(0, 0, MetaMessage('track_name', name='EVENTS', time=0))]
+    for section_number, tick in enumerate(section_ticks, 1):
+        events += [(tick, section_number, MetaMessage('text', text=f'[section Section {section_number}]', time=0))]
+    events += [(events[-1][0], len(events), MetaMessage('end_of_track', time=0))]
+    
+    return {"notes": np.zeros(0, dtype=chart.NOTE_DTYPE), "events": events}
     
-def print_midi(midi_file):
-    print(f"type={midi_file.type}, tracks={len(midi_file.tracks)}, ticks_per_beat={midi_file.ticks_per_beat}")
-    for i, track in enumerate(midi_file.tracks):
-        messages = []
-        name = ""
-        for j, message in enumerate(track): 
-            if message.type not in messages:
-                messages += [message.type]
-        print(f"'{track.name}' {i}:", messages)
+def print_midi(chart_tracks, ticks_per_beat):
+    print(f"type=1, tracks={len(chart_tracks)}, ticks_per_beat={ticks_per_beat}")
+    for i, track in enumerate(chart_tracks):
+        print(f"'{chart.get_track_name(track)}' {i}:", chart.get_message_types(track))
 
 
 if __name__ == '__main__':
@@ -121,10 +95,17 @@ if __name__ == '__main__':
     parser.add_argument('-i', '--inputs', action='append', nargs='+', required=True, help='A midi file with a single part')
     parser.add_argument('-o', '--output', default='notes.mid', help='An output midi file of all parts combined')
     
+    parser.add_argument('--profile', nargs='?', const='', default=None, metavar='JSON', help='Print the time and peak memory of each stage with some counters, and optionally save them to a json file')
+    
     args = vars(parser.parse_args())
+    if args['profile'] is not None:
+        profiler.enable()
 
     in_files =  [in_file for file_group in args['inputs'] for in_file in file_group]    # flatten to 1D array whether "-i $1 -i $2" or "-i $1 $2"
     out_file = args['output']
     
-    sys.exit(main(in_files, out_file))
+    result = main(in_files, out_file)
+    if args['profile'] is not None:
+        profiler.report(args['profile'])
+    sys.exit(result)
 
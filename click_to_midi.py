@@ -2,17 +2,57 @@
 
 import os
 import sys
+import glob
 import math
+import struct
+import zipfile
+import hashlib
 import argparse
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import soundfile as sf
+from mido import MidiFile, MidiTrack, MetaMessage
 
-from midiutil.MidiFile import MIDIFile
+import smf
+import atomic
+import batching
+import profiler
 
 ZERO = 1e-8
 BPM_TOL = 0.05      # min change for a new BPM to be set
+TICKS_PER_BEAT = 960    # midi resolution of the tempo map
 MIN_SILENCE = 0.001 # min amount of silence before new click
+BLOCK_SIZE = 65536  # samples read at a time when streaming
+ENVELOPE_FRAME = 64 # samples per frame of a click's energy envelope
+INDEX_VERSION = 1   # bump whenever the contents of the click index change
+CLASSIFY_BATCH = 1024   # clicks classified together in one pass
+MATCH_THRESHOLD = 0.7   # min normalized correlation with a click sample for the matched detector to call it a click
+
+# wav sample formats that can be analysed straight off the disk, PCM_24 has no numpy type and is unpacked instead
+MAPPED_SUBTYPES = {"PCM_16": "<i2", "PCM_24": "u1", "PCM_32": "<i4", "FLOAT": "<f4", "DOUBLE": "<f8"}
+FULL_SCALE = {"PCM_16": 2**15, "PCM_24": 2**23, "PCM_32": 2**31}    # mapped integer samples, floats are already 1
+
+INCREMENTAL_SPREAD = 8          # on average one in this many silences ends a block when re-analysing incrementally
+INCREMENTAL_BLOCK = (1, 10)     # min and max seconds in a block
+
+PARTS_PER_JOB = 4   # a long track is cut into this many parts per job, so one slow part doesn't hold up the rest
+
+AUDIO_FORMATS = [".wav", ".flac", ".ogg", ".aif", ".aiff"]   # picked up from folders in batch mode
+
+LOADED_CLICK_INDEXES = {}   # click indexes this process has already loaded, by key
+
+# the sample rate, whether to reduce bpm and time signature changes, and verbosity of the conversion running on each thread
+# a thread that hasn't been configured has the defaults, the bundled clicks' sample rate with events reduced
+class Settings(threading.local):
+    sample_rate = 44100
+    reduce_bpm_changes = True
+    reduce_sig_changes = True
+    verbose = False
+
+SETTINGS = Settings()
 
 def main(input, 
          output='',
@@ -22,21 +62,138 @@ def main(input,
          click_4th='clicks/quarter.wav', 
          click_8th='clicks/eigth.wav', 
          click_16th='clicks/sixteenth.wav', 
-         click_32nd='clicks/thirtysecond.wav'):
-
-    global SAMPLE_RATE, REDUCE_BPM_CHANGES, REDUCE_SIG_CHANGES, VERBOSE
+         click_32nd='clicks/thirtysecond.wav',
+         stream=False,
+         detector='threshold',
+         jobs=1,
+         incremental=False):
 
     in_file = input
     out_file = output if output != '' else os.path.splitext(input)[0] + ".mid"
     
-    SAMPLE_RATE = sf.read(in_file)[1]
+    info = sf.info(in_file)
+    configure(info.samplerate, force_events, verbose)
+    click_dicts = load_click_dicts(click_bar, click_4th, click_8th, click_16th, click_32nd)
+    
+    if stream:
+        if detector != 'threshold':
+            raise Exception(f"the {detector} detector can't be used when streaming")
+        with profiler.stage("stream click detection"):
+            click_arr = stream_click_arr(path=in_file, click_dicts=click_dicts)
+    elif incremental:
+        if detector != 'threshold':
+            raise Exception(f"the {detector} detector can't be used incrementally")
+        sidecar_path = os.path.splitext(out_file)[0] + ".clicks.npz"
+        with profiler.stage("incremental click detection"):
+            click_arr = incremental_click_arr(path=in_file, info=info, click_dicts=click_dicts, sidecar_path=sidecar_path)
+    else:
+        # uncompressed wavs are mapped rather than decoded
+        with profiler.stage("audio load"):
+            mapped = map_audio(in_file, info)
+            if mapped:
+                clock_audio, zero = mapped
+            else:
+                clock_audio, zero = prepare_audio(in_file), ZERO
+        click_arr = detect_clicks(clock_audio, click_dicts, zero, detector, jobs)
+    profiler.count("clicks detected", len(click_arr))
+    
+    with profiler.stage("midi build"):
+        midi = create_midi(click_arr=click_arr)
+
+    with profiler.stage("midi write"):
+        with open(out_file, "wb") as f:
+            f.write(midi)
+
+# the same as main for audio that's already decoded, an array of samples or of frames of channels
+# returns a MidiFile of the tempo track rather than writing anything
+def convert_buffer(audio,
+                   sample_rate,
+                   force_events=False,
+                   verbose=False,
+                   click_bar='clicks/bar.wav',
+                   click_4th='clicks/quarter.wav',
+                   click_8th='clicks/eigth.wav',
+                   click_16th='clicks/sixteenth.wav',
+                   click_32nd='clicks/thirtysecond.wav',
+                   detector='threshold',
+                   jobs=1):
+    
+    converter = ClickConverter(sample_rate, force_events, verbose, click_bar, click_4th, click_8th, click_16th, click_32nd, detector, jobs)
+    return converter.convert_tempo_map(audio)
+
+# the settings of a conversion and the click samples loaded for them, kept to convert many click tracks without loading anything again
+# convert can be called from many threads at once, the settings are only ever set for the thread a conversion runs on
+class ClickConverter:
+    def __init__(self,
+                 sample_rate=44100,
+                 force_events=False,
+                 verbose=False,
+                 click_bar='clicks/bar.wav',
+                 click_4th='clicks/quarter.wav',
+                 click_8th='clicks/eigth.wav',
+                 click_16th='clicks/sixteenth.wav',
+                 click_32nd='clicks/thirtysecond.wav',
+                 detector='threshold',
+                 jobs=1):
+        
+        self.sample_rate = sample_rate
+        self.force_events = force_events
+        self.verbose = verbose
+        self.detector = detector
+        self.jobs = jobs
+        
+        with self.configured():
+            self.click_dicts = load_click_dicts(click_bar, click_4th, click_8th, click_16th, click_32nd)
+    
+    # audio is a path, or an array of samples or of frames of channels at sample_rate, which defaults to the converter's
+    # returns the bytes of the midi file
+    def convert(self, audio, sample_rate=None):
+        with self.configured():
+            click_arr = self.find_clicks(audio, sample_rate)
+            with profiler.stage("midi build"):
+                return create_midi(click_arr=click_arr)
+    
+    # the same, but returns a MidiFile of just the tempo track
+    def convert_tempo_map(self, audio, sample_rate=None):
+        with self.configured():
+            click_arr = self.find_clicks(audio, sample_rate)
+            with profiler.stage("midi build"):
+                return create_tempo_midi_file(create_tempo_map(click_arr))
+    
+    # the converter's settings for the thread it's running on, then whatever the thread had before
+    @contextmanager
+    def configured(self):
+        previous = dict(vars(SETTINGS))
+        configure(self.sample_rate, self.force_events, self.verbose)
+        try:
+            yield
+        finally:
+            vars(SETTINGS).clear()
+            vars(SETTINGS).update(previous)
+    
+    def find_clicks(self, audio, sample_rate=None):
+        with self.configured():
+            with profiler.stage("audio load"):
+                if isinstance(audio, str):
+                    mapped = map_audio(audio, sf.info(audio))
+                    clock_audio, zero = mapped if mapped else (prepare_audio(audio), ZERO)
+                else:
+                    if sample_rate not in [None, self.sample_rate]:
+                        raise Exception(f"Incorrect sample rate: audio is {sample_rate}hz, expected {self.sample_rate}hz")
+                    clock_audio, zero = prepare_buffer(audio), ZERO
+            click_arr = detect_clicks(clock_audio, self.click_dicts, zero, self.detector, self.jobs)
+        profiler.count("clicks detected", len(click_arr))
+        return click_arr
+
+def configure(sample_rate, force_events=False, verbose=False):
+    SETTINGS.sample_rate = sample_rate
     
-    REDUCE_BPM_CHANGES = not force_events
-    REDUCE_SIG_CHANGES = not force_events
+    SETTINGS.reduce_bpm_changes = not force_events
+    SETTINGS.reduce_sig_changes = not force_events
     
-    VERBOSE = verbose
+    SETTINGS.verbose = verbose
 
-    # create click_array
+def load_click_dicts(click_bar, click_4th, click_8th, click_16th, click_32nd):
     click_dicts = [
         {"division": 1, "path": click_bar},
         {"division": 4, "path": click_4th},
@@ -44,167 +201,553 @@ def main(input,
         {"division": 16, "path": click_16th},
         {"division": 32, "path": click_32nd},
     ]
-    init_click_dicts(click_dicts=click_dicts)
+    with profiler.stage("load clicks"):
+        init_click_dicts(click_dicts=click_dicts)
+    return click_dicts
+
+# finds every click in audio that's all in memory, with whichever detector
+def detect_clicks(audio, click_dicts, zero=ZERO, detector='threshold', jobs=1):
+    if detector == 'matched':
+        with profiler.stage("matched click detection"):
+            return match_click_arr(audio=audio, click_dicts=click_dicts)
+    elif jobs and jobs > 1:
+        with profiler.stage("parallel click detection"):
+            return parallel_click_arr(audio=audio, click_dicts=click_dicts, zero=zero, jobs=jobs)
+    else:
+        return create_click_arr(audio=audio, click_dicts=click_dicts, zero=zero)
+
+# converts many click tracks at once, spread over a pool of worker processes
+# a file that fails is reported and the rest carry on
+def batch(inputs, output_dir='', jobs=None, **options):
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    
+    tasks = []
+    for in_file in find_inputs(inputs):
+        out_file = os.path.join(output_dir, os.path.splitext(os.path.basename(in_file))[0] + ".mid") if output_dir else ''
+        tasks += [(in_file, convert_file, (in_file, out_file, options))]
     
-    clock_audio = prepare_audio(in_file)
-    click_arr = create_click_arr(audio=clock_audio, click_dicts=click_dicts)
-    midi = create_midi(click_arr=click_arr)
+    failures = batching.run(tasks, jobs, "Converted", "click tracks")
+    return 1 if failures else 0
 
-    with open(out_file, "wb") as f:
-        midi.writeFile(f)
+def convert_file(in_file, out_file, options):
+    out_file = out_file or os.path.splitext(in_file)[0] + ".mid"
+    main(in_file, out_file, **options)
+    return out_file
 
-def create_click_arr(audio, click_dicts):
+# files, folders of audio files and glob patterns to a list of files
+def find_inputs(inputs):
+    in_files = []
+    for path in inputs:
+        if os.path.isdir(path):
+            found = sorted(os.path.join(path, f) for f in os.listdir(path) if os.path.splitext(f)[1].lower() in AUDIO_FORMATS)
+        elif glob.has_magic(path):
+            found = sorted(glob.glob(path, recursive=True))
+        else:
+            found = [path]
+        in_files += [f for f in found if f not in in_files]
+    return in_files
 
-    silent = True
-    click_start = 0
+def create_click_arr(audio, click_dicts, zero=ZERO):
 
     click_arr = []
     
-    for index, sample in enumerate(audio):
-
-        # Detect click begin
-        if abs(sample) > ZERO and silent:
-            click_start = index
-            silent = False
+    with profiler.stage("click detection"):
+        click_starts, click_ends = find_click_bounds(audio, zero=zero)
+    with profiler.stage("classification"):
+        divisions, confidences = classify_clicks(audio, click_starts, click_ends, click_dicts)
+    for click_start, division, confidence in zip(click_starts, divisions, confidences):
+        click_arr += [{
+            "start_samples": int(click_start),
+            "division": division,
+            "confidence": confidence,
+        }]
 
-        # Detect click end
-        elif all(abs(s) < ZERO for s in audio[index:index+seconds_to_samples(MIN_SILENCE)]) and not silent:
-            silent = True
-            click_arr += [{
-                "start_samples": click_start,
-                "division": find_click_division(input_audio=audio[click_start:index], 
-                                                click_dicts=click_dicts)
-            }]
+    return click_arr
 
+# same as create_click_arr but the audio is cut up at silences and the parts analysed on separate processes
+def parallel_click_arr(audio, click_dicts, zero=ZERO, jobs=None):
+    jobs = jobs or os.cpu_count()
+    splits = find_split_points(audio, parts=jobs * PARTS_PER_JOB, zero=zero)
+    
+    click_arr = []
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(analyse_part, np.asarray(audio[start:end]), click_dicts, zero, SETTINGS.sample_rate) 
+                   for start, end in zip(splits[:-1], splits[1:])]
+        
+        for start, future in zip(splits, futures):
+            for click in future.result():
+                click["start_samples"] += start
+                click_arr += [click]
+    
     return click_arr
 
-def create_midi(click_arr): 
-    midi_file = init_midi()
+def analyse_part(audio, click_dicts, zero, sample_rate):
+    configure(sample_rate)
     
-    bar_complete = False
-    bar_start = 0
-    time_slip = 0
+    return create_click_arr(audio=audio, click_dicts=click_dicts, zero=zero)
+
+# where to cut the audio into roughly equal parts without changing what's detected
+# each cut goes MIN_SILENCE into a silence, so the click before it has already ended and the next hasn't started
+def find_split_points(audio, parts, zero=ZERO):
+    min_silence = max(seconds_to_samples(MIN_SILENCE), 1)
+    splits = [0]
     
-    bpm = None
+    for target in range(0, len(audio), max(-(-len(audio) // parts), 1)):
+        if target <= splits[-1]:
+            continue
+        
+        # look further and further ahead until there's enough silence
+        search = SETTINGS.sample_rate
+        while target < len(audio):
+            window = audio[target:target + search]
+            edges = np.diff(((window < zero) & (window > -zero)).astype(np.int8), prepend=0, append=0)
+            run_starts = np.flatnonzero(edges == 1)
+            run_ends = np.flatnonzero(edges == -1)
+            long_enough = np.flatnonzero(run_ends - run_starts >= min_silence)
+            
+            if len(long_enough):
+                splits += [target + int(run_starts[long_enough[0]]) + min_silence]
+                break
+            if target + search >= len(audio):
+                break
+            search *= 2
     
-    numerator = 1
-    denominator = None
-    time_sig = None
+    if splits[-1] < len(audio):
+        splits += [len(audio)]
+    return splits
 
-    for index in range(len(click_arr)):
-        division = click_arr[index]["division"]
+# same as create_click_arr but only the parts of the audio that changed since the last run are analysed
+# the audio is cut into blocks at silences and the clicks of each block are saved in a sidecar by the block's hash,
+# so a block that's only moved because of an edit before it is still found
+# levels are relative to full scale like when streaming, so an edit in one place can't change what's detected in another
+def incremental_click_arr(path, info, click_dicts, sidecar_path):
+    mapped = map_audio(path, info)
+    if mapped:
+        audio, zero = mapped[0], ZERO * FULL_SCALE.get(info.subtype, 1)
+    else:
+        audio, _ = sf.read(path)
+        if audio.ndim != 1:
+            audio = np.mean(audio, axis=1)
+        zero = ZERO
+    
+    key = hashlib.sha1(f"v{INDEX_VERSION}:{get_click_index_key(click_dicts)}:{SETTINGS.sample_rate}:{MIN_SILENCE}:{info.subtype}:{zero}".encode()).hexdigest()
+    known_blocks = load_sidecar(sidecar_path, key)
+    
+    click_arr = []
+    block_hashes = []
+    reused = 0
+    splits = find_block_splits(audio, zero)
+    for start, end in zip(splits[:-1], splits[1:]):
+        block_hash = hashlib.sha1(np.ascontiguousarray(audio[start:end])).hexdigest()
         
-        # fixes missing last notes
-        if index == len(click_arr) - 1 and division != 1:
-            numerator += 1
-            division = 1
+        if block_hash in known_blocks:
+            reused += 1
+        else:
+            known_blocks[block_hash] = create_click_arr(audio=audio[start:end], click_dicts=click_dicts, zero=zero)
         
-        # time signatures
-        if division == 1:
-            if index:
-                if numerator == 1:
-                    raise Exception("all bars must have more than 1 beat")
-                
-                if not REDUCE_SIG_CHANGES or time_sig != (numerator, denominator):
-                    time_sig = (numerator, denominator)
-                    
-                    if VERBOSE:
-                        print(f"SIG: {time_sig}")
-                    midi_file.addTimeSignature(track=0,
-                                               time=bar_start - time_slip,
-                                               numerator=numerator,
-                                               denominator=int(math.log(denominator, 2)),
-                                               clocks_per_tick=24)
-
-                bar_complete = True
+        block_hashes += [block_hash]
+        for click in known_blocks[block_hash]:
+            click_arr += [dict(click, start_samples=start + click["start_samples"])]
+    
+    if SETTINGS.verbose:
+        print(f"Reused {reused} of {len(block_hashes)} blocks")
+    
+    save_sidecar(sidecar_path, key, block_hashes, known_blocks)
+    
+    return click_arr
+
+# like find_split_points, but where the blocks end only depends on the audio around them
+def find_block_splits(audio, zero=ZERO):
+    min_silence = max(seconds_to_samples(MIN_SILENCE), 1)
+    min_block, max_block = (seconds_to_samples(seconds) for seconds in INCREMENTAL_BLOCK)
+    
+    edges = np.diff(((audio < zero) & (audio > -zero)).astype(np.int8), prepend=0, append=0)
+    run_starts = np.flatnonzero(edges == 1)
+    run_lengths = np.flatnonzero(edges == -1) - run_starts
+    long_enough = run_lengths >= min_silence
+    
+    splits = [0]
+    for cut, run_length in zip((run_starts[long_enough] + min_silence).tolist(), run_lengths[long_enough].tolist()):
+        if cut - splits[-1] >= min_block and (run_length % INCREMENTAL_SPREAD == 0 or cut - splits[-1] >= max_block):
+            splits += [cut]
+    
+    if splits[-1] < len(audio):
+        splits += [len(audio)]
+    return splits
+
+# the clicks of each block from the last run, by block hash
+def load_sidecar(sidecar_path, key):
+    if not os.path.isfile(sidecar_path):
+        return {}
+    
+    try:
+        with np.load(sidecar_path) as sidecar:
+            if str(sidecar["key"]) != key:
+                return {}
             
-        else:
-            if not denominator:
-                denominator = division
-            elif denominator != division:
-                raise Exception(f"measure starting at {samples_to_seconds(click_arr[bar_start]['start_samples'])}s has multiple divisions of clicks.\nsometimes this can happen if your DAW isn't set to reder at 44.1khz, the sample rate of the default clicks")
+            known_blocks = {}
+            click_ends = np.cumsum(sidecar["click_counts"]).tolist()
+            for block_hash, end, count in zip(sidecar["block_hashes"].tolist(), click_ends, sidecar["click_counts"].tolist()):
+                known_blocks[block_hash] = [{
+                    "start_samples": int(sidecar["start_samples"][i]),
+                    "division": int(sidecar["divisions"][i]),
+                    "confidence": float(sidecar["confidences"][i]),
+                } for i in range(end - count, end)]
             
-            numerator += 1
+    except (OSError, KeyError, ValueError, EOFError, zipfile.BadZipFile):
+        return {}
+    
+    return known_blocks
 
-        # once sig is determined, calc and apply bpm
-        if bar_complete:
+def save_sidecar(sidecar_path, key, block_hashes, known_blocks):
+    unique_hashes = list(dict.fromkeys(block_hashes))
+    clicks = [click for block_hash in unique_hashes for click in known_blocks[block_hash]]
+    
+    try:
+        with atomic.replacing(sidecar_path) as temp_path, open(temp_path, "wb") as f:
+            np.savez(f,
+                     key=key,
+                     block_hashes=np.array(unique_hashes, dtype=str),
+                     click_counts=np.array([len(known_blocks[block_hash]) for block_hash in unique_hashes], dtype=np.int64),
+                     start_samples=np.array([click["start_samples"] for click in clicks], dtype=np.int64),
+                     divisions=np.array([click["division"] for click in clicks], dtype=np.int64),
+                     confidences=np.array([click["confidence"] for click in clicks], dtype=np.float64))
+    except OSError:
+        pass    # next run just starts from scratch
+
+# same as create_click_arr but reads the file a block at a time, so memory stays flat however long the track is
+# levels are not normalized here, so ZERO is relative to full scale rather than the length of the file
+def stream_click_arr(path, click_dicts, block_size=BLOCK_SIZE):
+    
+    click_arr = []
+    
+    # audio that may belong to a click that hasn't ended yet, and where it starts in the file
+    pending = np.zeros(0)
+    pending_start = 0
+    
+    with sf.SoundFile(path) as f:
+        if f.samplerate != SETTINGS.sample_rate:
+            raise Exception(f"Incorrect sample rate: {path} is {f.samplerate}hz, expected {SETTINGS.sample_rate}hz")
+        
+        final = False
+        while not final:
+            block = f.read(block_size)
+            final = len(block) < block_size
             
-            # fixes missing last note
-            if index == len(click_arr) - 1:
-                index += 1
-                
-            for jndex in range(bar_start, index):
-                
-                # add click notes
-                midi_file.addNote(track=0, 
-                                  channel=0,
-                                  pitch=12 if jndex == bar_start else 13,
-                                  time=jndex - time_slip, 
-                                  duration=4/denominator,
-                                  volume=127)
-                
-                # add bpm
-                try:
-                    time_between_samples = click_arr[jndex+1]["start_samples"] - click_arr[jndex]["start_samples"]
-                    new_bpm = round((4/denominator) * 60 * SAMPLE_RATE / time_between_samples, 2)
-                    
-                    # Only change BPM if different enough
-                    if not REDUCE_BPM_CHANGES or (not bpm or abs(new_bpm - bpm) > BPM_TOL):
-                        bpm = new_bpm
-                        
-                        if VERBOSE:
-                            print(f"BPM: {bpm}")
-                        midi_file.addTempo(track=0, 
-                                           time=jndex - time_slip, 
-                                           tempo=bpm)
-
-                except IndexError:
-                    # If last note, no new bpm needed 
-                    pass 
-                
-                # handle 8th/16th/32nd note placements
-                if math.log(denominator, 2).is_integer() and denominator > 4:
-                    time_slip += 1 - (4/denominator)
+            if block.ndim != 1:
+                block = np.mean(block, axis=1)
+            
+            audio = np.concatenate((pending, block))
+            
+            # only the final block may end a click on silence shorter than MIN_SILENCE
+            click_starts, click_ends = find_click_bounds(audio, final=final)
+            divisions, confidences = classify_clicks(audio, click_starts, click_ends, click_dicts)
+            for click_start, division, confidence in zip(click_starts, divisions, confidences):
+                click_arr += [{
+                    "start_samples": pending_start + int(click_start),
+                    "division": division,
+                    "confidence": confidence,
+                }]
+            
+            # carry over from the first loud sample after the last click, silence before it doesn't matter to the next block
+            resume = click_ends[-1] if len(click_ends) else 0
+            loud = np.flatnonzero(np.abs(audio[resume:]) > ZERO)
+            cut = resume + (loud[0] if len(loud) else len(audio) - resume)
+            pending = audio[cut:]
+            pending_start += int(cut)
+    
+    return click_arr
+
+# finds clicks by cross-correlating the audio with every click sample instead of looking for silence
+# the best match gives the onset and division together, and a noise floor or dither doesn't get in the way
+def match_click_arr(audio, click_dicts, block_size=BLOCK_SIZE):
+    templates = [d["trimmed"] for d in click_dicts]
+    longest = max(len(t) for t in templates)
+    fft_size = 2**math.ceil(math.log2(block_size + longest - 1))
+    template_ffts = [np.conj(np.fft.rfft(t, fft_size)) for t in templates]
+    
+    # best normalized correlation at every sample and which click sample gave it
+    scores = np.zeros(len(audio), dtype=np.float32)
+    labels = np.zeros(len(audio), dtype=np.int8)
+    
+    # correlate a block at a time, each block reading a click's length into the next
+    for block_start in range(0, len(audio), block_size):
+        block_len = min(block_size, len(audio) - block_start)
+        segment = np.asarray(audio[block_start:block_start + block_len + longest - 1], dtype=np.float64)
+        segment = np.pad(segment, (0, block_len + longest - 1 - len(segment)))
+        segment_fft = np.fft.rfft(segment, fft_size)
+        energy = np.concatenate(([0], np.cumsum(segment**2)))
+        
+        block_scores = scores[block_start:block_start + block_len]
+        block_labels = labels[block_start:block_start + block_len]
+        for k, (template, template_fft) in enumerate(zip(templates, template_ffts)):
+            correlation = np.fft.irfft(segment_fft * template_fft, fft_size)[:block_len]
+            window_energy = energy[len(template):len(template) + block_len] - energy[:block_len]
+            window_norm = np.sqrt(np.maximum(window_energy, 0)) * np.linalg.norm(template)
+            score = np.divide(correlation, window_norm, out=np.zeros(block_len), where=window_norm > ZERO)
             
-            # prepare for next bar
-            numerator = 1
-            denominator = None
-            bar_start = index
-            bar_complete = False
+            better = score > block_scores
+            block_scores[better] = score[better]
+            block_labels[better] = k
+    
+    # a click is the best scoring sample of each run of good matches
+    candidates = np.flatnonzero(scores > MATCH_THRESHOLD)
+    spacing = min(len(t) for t in templates) // 2
+    runs = np.cumsum(np.diff(candidates, prepend=-spacing) >= spacing)
+    order = np.lexsort((-scores[candidates], runs))
+    onsets = candidates[order][np.diff(runs[order], prepend=-1) != 0]
+    
+    click_arr = []
+    for onset in onsets:
+        click_arr += [{
+            "start_samples": int(onset),
+            "division": click_dicts[labels[onset]]["division"],
+            "confidence": float(scores[onset]),
+        }]
+    
+    return click_arr
 
+def create_midi(click_arr): 
+    return write_midi(create_tempo_map(click_arr))
+
+# positions, lengths and tempos of every click note, plus the time signatures, all as arrays
+def create_tempo_map(click_arr):
+    
+    # a lone click never closes a bar
+    if len(click_arr) < 2:
+        empty = np.zeros(0, dtype=np.int64)
+        return {k: empty for k in ["note_ticks", "note_lengths", "note_pitches", "bpms", "bar_starts", "bar_ticks", "numerators", "denominators"]}
+    
+    onsets = np.array([click["start_samples"] for click in click_arr], dtype=np.int64)
+    divisions = np.array([click["division"] for click in click_arr], dtype=np.int64)
+    last = len(click_arr) - 1
+    
+    # every bar line starts a new bar, bar 0 starts on the first click whatever it is
+    # the last click always closes the final bar, and is counted in it if it isn't a bar line itself
+    bar_starts = np.concatenate(([0], np.flatnonzero(divisions[1:last] == 1) + 1))
+    bar_ends = np.append(bar_starts[1:], len(click_arr))
+    
+    numerators = []
+    denominators = []
+    for bar_start, bar_end in zip(bar_starts, bar_ends):
+        counted_end = last if bar_end == len(click_arr) and divisions[last] == 1 and last else bar_end
+        sub_divisions = divisions[bar_start:counted_end][divisions[bar_start:counted_end] != 1]
+        
+        # the last click closes the bar rather than setting its division
+        checked = sub_divisions[:-1] if bar_end == len(click_arr) and divisions[last] != 1 else sub_divisions
+        if len(checked) and np.any(checked != checked[0]):
+            raise Exception(f"measure starting at {samples_to_seconds(click_arr[bar_start]['start_samples'])}s has multiple divisions of clicks.\nsometimes this can happen if your DAW isn't set to reder at 44.1khz, the sample rate of the default clicks")
+        if not len(sub_divisions):
+            raise Exception("all bars must have more than 1 beat")
+        
+        numerators += [1 + len(sub_divisions)]
+        denominators += [int(checked[0] if len(checked) else sub_divisions[-1])]
+    
+    # each note of a bar lasts 4/denominator beats, and moves the next note on by as much
+    # unless it's slower than a quarter note, then it's still 1 beat on
+    bar_of_note = np.repeat(np.arange(len(bar_starts)), bar_ends - bar_starts)
+    note_denominators = np.array(denominators, dtype=np.int64)[bar_of_note]
+    note_lengths = 4 / note_denominators
+    is_subdivided = (note_denominators > 4) & (np.log2(note_denominators) % 1 == 0)
+    note_beats = np.concatenate(([0], np.cumsum(np.where(is_subdivided, note_lengths, 1))[:-1]))
+    
+    # tempo from the gap to the next click, the very last click has no tempo of its own
+    bpms = note_lengths[:-1] * 60 * SETTINGS.sample_rate / np.diff(onsets)
+    
+    return {
+        "note_ticks": (note_beats * TICKS_PER_BEAT).astype(np.int64),
+        "note_lengths": (note_lengths * TICKS_PER_BEAT).astype(np.int64),
+        "note_pitches": np.where(np.isin(np.arange(len(click_arr)), bar_starts), 12, 13),
+        "bpms": np.array([round(bpm, 2) for bpm in bpms.tolist()]),
+        "bar_starts": bar_starts,
+        "bar_ticks": (note_beats[bar_starts] * TICKS_PER_BEAT).astype(np.int64),
+        "numerators": np.array(numerators, dtype=np.int64),
+        "denominators": np.array(denominators, dtype=np.int64),
+    }
+
+# the time signature and tempo events of the tempo track, as (tick, order, type, value) in the order they're written
+def get_tempo_events(tempo_map):
+    
+    note_ticks = tempo_map["note_ticks"].tolist()
+    bpms = tempo_map["bpms"].tolist()
+    bar_starts = tempo_map["bar_starts"].tolist()
+    bar_ends = bar_starts[1:] + [len(note_ticks)]
+    
+    # tempo track, a time signature goes before a tempo on the same tick
+    tempo_events = []
+    time_sig = None
+    bpm = None
+    for bar, (bar_start, bar_end) in enumerate(zip(bar_starts, bar_ends)):
+        numerator = int(tempo_map["numerators"][bar])
+        denominator = int(tempo_map["denominators"][bar])
+        
+        if not SETTINGS.reduce_sig_changes or time_sig != (numerator, denominator):
+            time_sig = (numerator, denominator)
+            
+            if SETTINGS.verbose:
+                print(f"SIG: {time_sig}")
+            profiler.count("time signature events")
+            tempo_events += [(int(tempo_map["bar_ticks"][bar]), 0, "time_signature", time_sig)]
+        
+        for new_bpm, tick in zip(bpms[bar_start:bar_end], note_ticks[bar_start:bar_end]):
+            
+            # Only change BPM if different enough
+            if not SETTINGS.reduce_bpm_changes or (not bpm or abs(new_bpm - bpm) > BPM_TOL):
+                bpm = new_bpm
+                
+                if SETTINGS.verbose:
+                    print(f"BPM: {bpm}")
+                profiler.count("bpm events")
+                tempo_events += [(tick, 3, "set_tempo", int(60000000 / bpm))]
+    
+    tempo_events.sort(key=lambda event: event[:2])
+    return tempo_events
+
+# a type 1 standard midi file of the tempo map, a tempo track of time signatures and tempos, then a BEAT track of click notes
+def write_midi(tempo_map):
+    
+    tempo_events = []
+    for tick, order, event_type, value in get_tempo_events(tempo_map):
+        if event_type == "time_signature":
+            tempo_events += [(tick, order, bytes([0xFF, 0x58, 0x04, value[0], int(math.log(value[1], 2)), 24, 8]))]
+        else:
+            tempo_events += [(tick, order, b"\xff\x51\x03" + struct.pack(">L", value)[1:])]
+    
+    # click notes, a note off goes before a note on on the same tick
+    note_events = [(0, 0, b"\xff\x03" + smf.write_var_length(len("BEAT")) + "BEAT".encode("ISO-8859-1"))]
+    for tick, length, pitch in zip(*(tempo_map[k].tolist() for k in ["note_ticks", "note_lengths", "note_pitches"])):
+        note_events += [(tick, 3, bytes([0x90, pitch, 127])), (tick + length, 2, bytes([0x80, pitch, 127]))]
+    
+    midi = bytearray(smf.write_header(2, TICKS_PER_BEAT))
+    for events in [tempo_events, note_events]:
+        events.sort(key=lambda event: event[:2])
+        
+        track = bytearray()
+        previous_tick = 0
+        for tick, _, data in events:
+            track += smf.write_var_length(tick - previous_tick)
+            track += data
+            previous_tick = tick
+        track += b"\x00\xff\x2f\x00"
+        
+        midi += smf.write_track_chunk(track)
+    
+    return bytes(midi)
+
+# a MidiFile of just the tempo track, for building on in memory without writing and reading back the click notes
+def create_tempo_midi_file(tempo_map):
+    track = MidiTrack()
+    previous_tick = 0
+    for tick, _, event_type, value in get_tempo_events(tempo_map):
+        if event_type == "time_signature":
+            track.append(MetaMessage("time_signature", numerator=value[0], denominator=value[1], clocks_per_click=24, notated_32nd_notes_per_beat=8, time=tick - previous_tick))
+        else:
+            track.append(MetaMessage("set_tempo", tempo=value, time=tick - previous_tick))
+        previous_tick = tick
+    track.append(MetaMessage("end_of_track", time=0))
+    
+    midi_file = MidiFile(type=1, ticks_per_beat=TICKS_PER_BEAT)
+    midi_file.tracks.append(track)
     return midi_file
 
 # INITS
 
 def init_click_dicts(click_dicts):
+    key = get_click_index_key(click_dicts)
+    index_path = os.path.join(os.path.dirname(click_dicts[0]["path"]), f".click_index_{key[:16]}.npz")
+    
+    # a process converting many files only loads the clicks once
+    if key in LOADED_CLICK_INDEXES:
+        for d, fields in zip(click_dicts, LOADED_CLICK_INDEXES[key]):
+            d.update(fields)
+    elif not load_click_index(click_dicts, index_path, key):
+        for d in click_dicts:
+            d.update(index_click(prepare_audio(d["path"])))
+        save_click_index(click_dicts, index_path, key)
+    
+    LOADED_CLICK_INDEXES[key] = [{k: v for k, v in d.items() if k not in ["division", "path"]} for d in click_dicts]
+    
     for d in click_dicts:
-        d["audio"] = prepare_audio(d["path"])
-        
+        if d["sample_rate"] != SETTINGS.sample_rate:
+            raise Exception(f"Incorrect sample rate: {d['path']} is {d['sample_rate']}hz, expected {SETTINGS.sample_rate}hz")
         
     # ensure no 2 sounds will get mixed up
     # likely any two sounds at the same length and pitch will probably fail here
     low = 0
     while low < len(click_dicts):
         for i in range(low+1, len(click_dicts)):
-            if get_zcr(click_dicts[low]["audio"]) == get_zcr(click_dicts[i]["audio"]):
+            if click_dicts[low]["zcr"] == click_dicts[i]["zcr"]:
                 Exception(f"Two clicks samples, {click_dicts[low]['division']}:{click_dicts[low]['path']} and {click_dicts[i]['division']}:{click_dicts[i]['path']}, sound too similar")
         low += 1
     
-def init_midi():
-    midi_file = MIDIFile(1, file_format=1)
-    midi_file.addTrackName(track=0, time=0, trackName="BEAT")
+# everything about a click sample that's worth working out only once
+def index_click(audio):
+    frames = np.pad(audio, (0, -len(audio) % ENVELOPE_FRAME)).reshape(-1, ENVELOPE_FRAME)
+    
+    return {
+        "audio": audio,
+        "trimmed": np.trim_zeros(audio),
+        "envelope": np.sqrt(np.mean(frames**2, axis=1)),
+        "length": len(audio),
+        "zcr": get_zcr(audio),
+        "zcr_by_length": get_zcr_curve(audio[1:]),  # zcr of the click as compared in find_click_division, for every length
+        "sample_rate": SETTINGS.sample_rate,
+    }
 
-    return midi_file
+# CLICK INDEX CACHE
+# saved next to the click samples and keyed by their contents, so it's only rebuilt when a sample changes
 
+def get_click_index_key(click_dicts):
+    sha = hashlib.sha1(f"v{INDEX_VERSION}".encode())
+    for d in click_dicts:
+        sha.update(f"{d['division']}:".encode())
+        with open(d["path"], "rb") as f:
+            sha.update(hashlib.sha1(f.read()).digest())
+    return sha.hexdigest()
+
+def load_click_index(click_dicts, index_path, key):
+    if not os.path.isfile(index_path):
+        return False
+    
+    try:
+        with np.load(index_path) as index:
+            if str(index["key"]) != key:
+                return False
+            
+            for d in click_dicts:
+                fields = {field: index[f"{d['division']}_{field}"] for field in ["audio", "trimmed", "envelope", "zcr_by_length"]}
+                fields.update({field: int(index[f"{d['division']}_{field}"]) for field in ["length", "zcr", "sample_rate"]})
+                d.update(fields)
+                
+    except (OSError, KeyError, ValueError, EOFError, zipfile.BadZipFile):
+        return False    # unreadable, cut short or from an older version, just rebuild it
+    
+    return True
+
+def save_click_index(click_dicts, index_path, key):
+    fields = ["audio", "trimmed", "envelope", "length", "zcr", "zcr_by_length", "sample_rate"]
+    index = {f"{d['division']}_{field}": d[field] for d in click_dicts for field in fields}
+    
+    # written whole then moved into place, as batch workers all build it at once
+    try:
+        with atomic.replacing(index_path) as temp_path:
+            with open(temp_path, "wb") as f:
+                np.savez(f, key=key, **index)
+    except OSError:
+        pass    # a read only clicks folder only means no cache
+    
 # DSP UTILS
 def find_click_division(input_audio, click_dicts):
-    for division, click_audio in ((d["division"], d["audio"]) for d in click_dicts):
+    for division, click_audio, zcr_by_length in ((d["division"], d["audio"], d["zcr_by_length"]) for d in click_dicts):
         input_audio, click_audio = make_buffers_comparable(input_audio, click_audio[1:])
         
         # the lazy way
-        if get_zcr(click_audio) == get_zcr(input_audio):
+        if zcr_by_length[len(click_audio)] == get_zcr(input_audio):
+            profiler.count("zcr matches")
             return division
     
+    profiler.count("identicality fallbacks")
     # backup in case lazy way doesn't work
     best_division = ""
     lowest_error = None
@@ -217,12 +760,93 @@ def find_click_division(input_audio, click_dicts):
             
     return best_division
 
+# batched find_click_division, every click is scored against every click sample at once
+# confidence is how much closer the chosen sample is than the next best one, from 0 to 1
+def classify_clicks(audio, click_starts, click_ends, click_dicts):
+    templates = [np.trim_zeros(d["audio"]/np.linalg.norm(d["audio"])) for d in click_dicts]
+    
+    # find_click_division cuts the click down to each sample's length as it goes
+    compared_lengths = np.minimum.accumulate([d["length"] - 1 for d in click_dicts])
+    
+    divisions = []
+    confidences = []
+    for batch in range(0, len(click_starts), CLASSIFY_BATCH):
+        starts = np.asarray(click_starts[batch:batch+CLASSIFY_BATCH])
+        lengths = np.asarray(click_ends[batch:batch+CLASSIFY_BATCH]) - starts
+        rows = np.arange(len(starts))
+        
+        # stack the clicks into rows padded with silence, copying so the audio is left alone
+        width = min(lengths.max(), compared_lengths[0])
+        offsets = np.arange(width)
+        in_click = offsets < lengths[:, None]
+        clicks = np.where(in_click, audio[np.minimum(starts[:, None] + offsets, len(audio) - 1)], 0.0)
+        
+        # the lazy way, a matching zcr at the compared length
+        cuts = np.minimum(lengths[:, None], compared_lengths)
+        click_zcrs = np.take_along_axis(get_zcr_curve(clicks), cuts, axis=1)
+        template_zcrs = np.stack([d["zcr_by_length"][cuts[:, k]] for k, d in enumerate(click_dicts)], axis=1)
+        zcr_matches = click_zcrs == template_zcrs
+        
+        # backup, the sample identicality of each click against each sample
+        # normalized over the final compared length and lined up from their first sound
+        compared = np.where(offsets < cuts[:, -1:], clicks, 0)
+        compared /= np.linalg.norm(compared, axis=1, keepdims=True)
+        sound = compared != 0
+        first_sound = np.argmax(sound, axis=1)
+        sound_lengths = width - np.argmax(sound[:, ::-1], axis=1) - first_sound
+        compared = np.take_along_axis(compared, np.minimum(first_sound[:, None] + offsets, width - 1), axis=1)
+        
+        errors = np.empty((len(starts), len(templates)))
+        for k, template in enumerate(templates):
+            overlap = min(width, len(template))
+            counted = offsets[:overlap] < np.minimum(sound_lengths, len(template))[:, None] - 1
+            errors[:, k] = np.sum(np.abs(compared[:, :overlap] - template[:overlap]) * counted, axis=1)
+        
+        best = np.where(zcr_matches.any(axis=1), np.argmax(zcr_matches, axis=1), np.argmin(errors, axis=1))
+        profiler.count("zcr matches", int(zcr_matches.any(axis=1).sum()))
+        profiler.count("identicality fallbacks", int((~zcr_matches.any(axis=1)).sum()))
+        
+        runner_up = errors.copy()
+        runner_up[rows, best] = np.inf
+        runner_up = runner_up.min(axis=1)
+        closeness = np.divide(errors[rows, best], runner_up, out=np.ones(len(starts)), where=runner_up > 0)
+        
+        divisions += [click_dicts[k]["division"] for k in best]
+        confidences += np.clip(1 - closeness, 0, 1).tolist()
+    
+    return divisions, confidences
+
+# start and end indices of every click, a click ends where at least MIN_SILENCE of silence begins
+# zero is the level of silence in the same units as the audio
+def find_click_bounds(audio, final=True, zero=ZERO):
+    loud = np.flatnonzero((audio > zero) | (audio < -zero))
+
+    # run length encode the silence, keeping runs that are long enough or reach the end of the audio
+    # when more audio is still to come, a short run at the end may yet turn out long enough
+    edges = np.diff(((audio < zero) & (audio > -zero)).astype(np.int8), prepend=0, append=0)
+    run_starts = np.flatnonzero(edges == 1)
+    run_ends = np.flatnonzero(edges == -1)
+    long_enough = (run_ends - run_starts >= seconds_to_samples(MIN_SILENCE)) | (final & (run_ends == len(audio)))
+    silence_starts = run_starts[long_enough]
+    
+    # each click starts on the first loud sample after the previous silence
+    prev_silence = np.concatenate(([0], silence_starts))[:len(silence_starts)]
+    first_loud = np.searchsorted(loud, prev_silence)
+    has_click = first_loud < len(loud)
+    click_starts = loud[first_loud[has_click]]
+    click_ends = silence_starts[has_click]
+    
+    # silences with no sound since the last one don't end a click
+    is_click = click_starts < click_ends
+    
+    return click_starts[is_click], click_ends[is_click]
+
 def make_buffers_comparable(audio_1, audio_2):
     min_len = min(len(audio_1), len(audio_2))
     max_1 = max(max(audio_1), abs(min(audio_1)))
     max_2 = max(max(audio_2), abs(min(audio_2)))
 
-    audio_1 *= max_2 / max_1
+    audio_1 = audio_1 * (max_2 / max_1)
     
     audio_1 = audio_1[:min_len]
     audio_2 = audio_2[:min_len]
@@ -234,20 +858,22 @@ def make_buffers_comparable(audio_1, audio_2):
 # zero crossing rate - thanks stooart for the suggestion :)
 def get_zcr(audio_buffer):
     assert audio_buffer.ndim == 1
+    
+    return int(get_zcr_curve(audio_buffer)[-1])
 
-    polarity = ""
-    crossing_count = 0
-
-    for s in audio_buffer:
-        if s > 0 and polarity != "positive":
-            polarity = "positive"
-            crossing_count += 1
-
-        elif s < 0 and polarity != "negative":
-            polarity = "negative"
-            crossing_count += 1
+# zero crossing rate of audio_buffer[..., :n] for every n, counting the first nonzero sample as a crossing
+def get_zcr_curve(audio_buffer):
+    polarity = np.sign(audio_buffer)
+    
+    # carry the polarity of the last nonzero sample over any zeros
+    positions = np.arange(audio_buffer.shape[-1])
+    last_nonzero = np.maximum.accumulate(np.where(polarity != 0, positions, 0), axis=-1)
+    held = np.take_along_axis(polarity, last_nonzero, axis=-1)
+    
+    previous = np.concatenate((np.zeros_like(held[..., :1]), held[..., :-1]), axis=-1)
+    crossings = (polarity != 0) & (held != previous)
 
-    return crossing_count
+    return np.concatenate((np.zeros_like(crossings[..., :1], dtype=np.int64), np.cumsum(crossings, axis=-1)), axis=-1)
 
 # sample identicality - just how "exactly the same" are these two sounds sample by sample?
 def get_sample_identicality(audio_1, audio_2):
@@ -266,9 +892,14 @@ def get_sample_identicality(audio_1, audio_2):
 def prepare_audio(path):
     audio, sr = sf.read(path)
     
-    if sr != SAMPLE_RATE:
-        raise Exception(f"Incorrect sample rate: {path} is {sr}hz, expected {SAMPLE_RATE}hz")
+    if sr != SETTINGS.sample_rate:
+        raise Exception(f"Incorrect sample rate: {path} is {sr}hz, expected {SETTINGS.sample_rate}hz")
     
+    return prepare_buffer(audio)
+
+# mono and normalized
+def prepare_buffer(audio):
+    audio = np.asarray(audio, dtype=np.float64)
     if audio.ndim != 1:
         audio = np.mean(audio, axis=1)
     
@@ -276,21 +907,79 @@ def prepare_audio(path):
     
     return audio
 
+# the loudest channel of an uncompressed wav, straight from the file with no float copy or normalizing
+# returns it with the level ZERO would be after normalizing, or None if the file has to be decoded
+def map_audio(path, info):
+    if info.format != "WAV" or info.subtype not in MAPPED_SUBTYPES:
+        return None
+    
+    if info.samplerate != SETTINGS.sample_rate:
+        raise Exception(f"Incorrect sample rate: {path} is {info.samplerate}hz, expected {SETTINGS.sample_rate}hz")
+    
+    offset = find_wav_data(path)
+    if offset is None:
+        return None
+    
+    shape = (info.frames, info.channels, 3) if info.subtype == "PCM_24" else (info.frames, info.channels)
+    frames = np.memmap(path, dtype=MAPPED_SUBTYPES[info.subtype], mode="r", offset=offset, shape=shape)
+    
+    energy = np.zeros(info.channels)
+    for block_start in range(0, info.frames, BLOCK_SIZE):
+        block = frames[block_start:block_start + BLOCK_SIZE]
+        if info.subtype == "PCM_24":
+            block = unpack_pcm_24(block)
+        energy += np.sum(np.square(block, dtype=np.float64), axis=0)
+    channel = int(np.argmax(energy))
+    
+    audio = frames[:, channel]
+    if info.subtype == "PCM_24":
+        audio = np.concatenate([unpack_pcm_24(audio[block_start:block_start + BLOCK_SIZE]) 
+                                for block_start in range(0, info.frames, BLOCK_SIZE)] or [np.zeros(0, dtype=np.int32)])
+    
+    return audio, ZERO * math.sqrt(energy[channel])
+
+# offset of the sample data in a little endian wav, None if it can't be found
+def find_wav_data(path):
+    with open(path, "rb") as f:
+        riff, _, wave = struct.unpack("<4sI4s", f.read(12))
+        if riff != b"RIFF" or wave != b"WAVE":
+            return None
+        
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return None
+            chunk_id, chunk_size = struct.unpack("<4sI", header)
+            if chunk_id == b"data":
+                return f.tell()
+            f.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
+
+# 3 byte little endian samples to int32
+def unpack_pcm_24(pcm):
+    padded = np.zeros(pcm.shape[:-1] + (4,), dtype=np.uint8)
+    padded[..., 1:] = pcm
+    return padded.view("<i4")[..., 0] >> 8
+
 def samples_to_seconds(num_samples):
-    return round(num_samples / SAMPLE_RATE, 3)
+    return round(num_samples / SETTINGS.sample_rate, 3)
 
 def seconds_to_samples(num_seconds):
-    return round(num_seconds * SAMPLE_RATE)
+    return round(num_seconds * SETTINGS.sample_rate)
 
 # Passthrough to main
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='A tool for converting click tracks to midi with tempo and time signature changes preserved')
-    parser.add_argument('-i', '--input', required=True, help='An input audio file of your clicktrack in full')
-    parser.add_argument('-o', '--output', required=False, default='', help='An output midi file to contain your tempo')
+    parser.add_argument('-i', '--input', action='append', nargs='+', required=True, help='An input audio file of your clicktrack in full, or several files, folders or glob patterns to convert as a batch')
+    parser.add_argument('-o', '--output', required=False, default='', help='An output midi file to contain your tempo, or an output folder for a batch')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='Number of click tracks to convert at once in a batch, defaults to the number of cores. For a single click track, the number of processes to analyse it with')
 
     parser.add_argument('-fe', '--force_events', action='store_true', help='Forces a BPM or time signature change midi event on every click, even when unecessary')
     parser.add_argument('-v', '--verbose', action='store_true', help='Display all BPM and time changes')
+    parser.add_argument('-s', '--stream', action='store_true', help='Analyse the click track a block at a time to keep memory use flat on very long renders')
+    parser.add_argument('-inc', '--incremental', action='store_true', help='Keep the clicks found in a sidecar next to the output, and only re-analyse the parts of the click track that changed since the last run')
+    parser.add_argument('-d', '--detector', choices=['threshold', 'matched'], default='threshold', help='Find clicks by the silence between them (threshold) or by correlating with the click samples (matched), which copes with noisy renders')
+    parser.add_argument('--profile', nargs='?', const='', default=None, metavar='JSON', help='Print the time and peak memory of each stage with some counters, and optionally save them to a json file. A batch only profiles its own process')
     
     parser.add_argument('-i1', '--click_bar', required=False, default='clicks/bar.wav', help='An input audio file of your barline click sound')
     parser.add_argument('-i4', '--click_4th', required=False, default='clicks/quarter.wav', help='An input audio file of your quatre note click sound')
@@ -299,15 +988,49 @@ if __name__ == '__main__':
     parser.add_argument('-i32', '--click_32nd', required=False, default='clicks/thirtysecond.wav', help='An input audio file of your thirty second note click sound')
     
     args = vars(parser.parse_args())
+    if args['profile'] is not None:
+        profiler.enable()
+    
+    in_files = [in_file for file_group in args['input'] for in_file in file_group]   # flatten to 1D array whether "-i $1 -i $2" or "-i $1 $2"
+    
+    # a batch is several inputs, a folder or a glob pattern, so a mistyped file isn't taken for one with -o made into a folder
+    is_batch = len(in_files) > 1 or (not os.path.isfile(in_files[0]) and (os.path.isdir(in_files[0]) or glob.has_magic(in_files[0])))
+    if not is_batch and not os.path.isfile(in_files[0]):
+        parser.error(f"argument -i/--input: can't find '{in_files[0]}'")
+    
+    if is_batch:
+        result = batch(
+            in_files,
+            args['output'],
+            args['jobs'],
+            force_events=args['force_events'],
+            verbose=args['verbose'],
+            click_bar=args['click_bar'],
+            click_4th=args['click_4th'],
+            click_8th=args['click_8th'],
+            click_16th=args['click_16th'],
+            click_32nd=args['click_32nd'],
+            stream=args['stream'],
+            detector=args['detector'],
+            incremental=args['incremental'],
+        )
+    else:
+        result = main(
+            in_files[0],
+            args['output'],
+            args['force_events'],
+            args['verbose'],
+            args['click_bar'],
+            args['click_4th'],
+            args['click_8th'],
+            args['click_16th'],
+            args['click_32nd'],
+            args['stream'],
+            args['detector'],
+            args['jobs'],
+            args['incremental'],
+        )
     
-    sys.exit(main(
-        args['input'],
-        args['output'],
-        args['force_events'],
-        args['verbose'],
-        args['click_bar'],
-        args['click_4th'],
-        args['click_8th'],
-        args['click_16th'],
-        args['click_32nd'],
-    ))
+    if args['profile'] is not None:
+        profiler.report(args['profile'])
+    sys.exit(result)
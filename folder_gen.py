@@ -1,27 +1,64 @@
+import io
 import os
 import sys
+import json
+import time
+import select
+import struct
+import ctypes
+import ctypes.util
+import hashlib
+import tempfile
 import shutil
 import argparse
+import threading
+from contextlib import redirect_stdout
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+import soundfile as sf
+import scipy.signal
 from pydub import AudioSegment
 
 from PIL import Image, ImageFilter, ImageDraw
 
 import charts_to_notes
 import click_to_midi
+import atomic
+import batching
+import profiler
 
 AUDIO_FORMATS = [".mp3", ".ogg", ".wav", ".flac", ".aac"]
 IMAGE_FORMATS = [".png", ".jpg"]
 
 DIV_NUM_LINES = 80
-TARGET_LOUDNESS = -12.0
-TARGET_LOUDNESS = None
+TARGET_LOUDNESS = None     # LUFS song audio is turned down to, None leaves it as it is
+TRANSCODE_BLOCK = 65536     # frames read, measured and written at a time when transcoding
+GATE_LENGTH = 0.4           # seconds in each loudness gating block, they overlap by 75%
+K_WEIGHTING = [(4.0, 1/np.sqrt(2), 1500.0), (0.0, 0.5, 38.0)]     # gain in dB, Q and frequency of the BS.1770 high shelf then high pass
+CHANNEL_WEIGHTS = [1.0, 1.0, 1.0, 1.41, 1.41]   # BS.1770 weights of L, R, C, Ls, Rs, any more channels count as 1
 VERBOSE = False
+JOURNAL_NAME = ".folder_gen_journal.jsonl"   # songs a batch has finished, so an interrupted batch can pick up where it left off
+MANIFEST_NAME = ".build_manifest.json"      # what each output of a song folder was last built from
+BUILD_VERSION = 2   # bump whenever a stage builds something different from the same inputs
+WATCH_DEBOUNCE = 0.3    # seconds a song's sources have to stop changing for before it's rebuilt in watch mode
+WATCH_POLL = 0.5        # seconds between checks for changes when inotify isn't available
 
-def main(input, output=''):
+CLICKS_FOLDER = os.path.join(os.path.dirname(os.path.realpath(__file__)), "clicks")
+CLICK_CONVERTERS = {}   # click converters by sample rate and verbosity, kept warm for every song a process builds
+CLICK_CONVERTERS_LOCK = threading.Lock()
+CLICK_PATHS = {
+    "click_bar": os.path.join(CLICKS_FOLDER, "bar.wav"),
+    "click_4th": os.path.join(CLICKS_FOLDER, "quarter.wav"),
+    "click_8th": os.path.join(CLICKS_FOLDER, "eigth.wav"),
+    "click_16th": os.path.join(CLICKS_FOLDER, "sixteenth.wav"),
+    "click_32nd": os.path.join(CLICKS_FOLDER, "thirtysecond.wav"),
+}
+
+def main(input, output='', jobs=None, target_loudness=TARGET_LOUDNESS, verbose=VERBOSE):
     
     in_files = [os.path.join(input, f) for f in os.listdir(input) if  os.path.isfile(os.path.join(input, f))]
     
-    beat = ""
+    beat_files = []
     audio = ""
     image = ""
     ini = ""
@@ -32,12 +69,7 @@ def main(input, output=''):
         f = os.path.basename(file.lower())
         
         if "beat" in os.path.splitext(f)[0] and any(f.endswith(ext) for ext in AUDIO_FORMATS + [".mid"]):
-            if beat:
-                if f.endswith(".mid") and not beat.endswith(".mid"):
-                    beat = file # a beat midi file overrides a beat audio file, but only once
-                else:
-                    raise Exception("multiple beat files detected")
-            beat = file
+            beat_files += [file]
         elif any(f.endswith(ext) for ext in AUDIO_FORMATS):
             if audio:
               raise Exception("multiple track audio files detected")
@@ -67,6 +99,13 @@ def main(input, output=''):
         )
         output = os.path.join(output, os.path.splitext(os.path.basename(audio))[0])
     
+    # a beat midi file overrides a beat audio file, but only once
+    beat_midis = [file for file in beat_files if file.lower().endswith(".mid")]
+    beat_audios = [file for file in beat_files if not file.lower().endswith(".mid")]
+    if len(beat_midis) > 1 or len(beat_audios) > 1:
+        raise Exception("multiple beat files detected")
+    beat = (beat_midis + beat_audios + [""])[0]
+    
     print("Generate song from following items:",
         f"\tBeat - '{beat}'",
         f"\tAudio - '{audio}'",
@@ -78,9 +117,190 @@ def main(input, output=''):
         f"Output Folder - {output}",
         sep=os.linesep)
     
-    generate(beat, audio, instruments, event, image, ini, input, output)
+    generate(beat, audio, instruments, event, image, ini, input, output, jobs, target_loudness, verbose)
+    
+# builds every song folder in a root of source folders, spread over a pool of worker processes
+# finished songs are journaled as they complete, and skipped when the batch is run again until it all succeeds
+# a song that fails is reported and the rest carry on
+def batch(root, output_root='', jobs=None, fresh=False, target_loudness=TARGET_LOUDNESS, verbose=VERBOSE):
+    output_root = get_batch_output_root(root, output_root)
+    song_folders = find_song_folders(root, output_root)
+    journal_path = os.path.join(output_root, JOURNAL_NAME)
+    os.makedirs(output_root, exist_ok=True)
+    
+    finished = set()
+    if os.path.isfile(journal_path) and not fresh:
+        with open(journal_path) as f:
+            finished = {json.loads(line)["input"] for line in f if line.strip()}
+    elif os.path.isfile(journal_path):
+        os.remove(journal_path)
+    
+    song_folders = [song_folder for song_folder in song_folders if song_folder not in finished]
+    if finished:
+        print(f"Resuming, {len(finished)} songs already built")
+    
+    tasks = [(song_folder, build_song, (song_folder, os.path.join(output_root, os.path.basename(song_folder)), target_loudness, verbose)) for song_folder in song_folders]
+    with open(journal_path, "a") as journal:
+        def record(song_folder, _, seconds):
+            journal.write(json.dumps({"input": song_folder, "seconds": seconds}) + "\n")
+            journal.flush()
+        failures = batching.run(tasks, jobs, "Built", "songs", per_minute=True, on_done=record)
+    
+    if failures:
+        return 1
+    os.remove(journal_path)
+    return 0
+
+# one song of a batch, its stages run one at a time as the batch already keeps every core busy
+# the options are passed in rather than read from globals, worker processes that are spawned don't get the ones set by the command line
+def build_song(song_folder, output, target_loudness, verbose):
+    with redirect_stdout(io.StringIO()):
+        main(song_folder, output, 1, target_loudness, verbose)
+
+# builds the song folder, or every song folder in it for a batch, then keeps rebuilding any song whose sources change
+# a burst of saves is waited out before rebuilding, and only the outputs built from what changed are made again
+def watch(input, output='', batch_mode=False, jobs=None, poll=False, target_loudness=TARGET_LOUDNESS, verbose=VERBOSE):
+    if batch_mode:
+        output = get_batch_output_root(input, output)
+    songs = find_song_folders(input, output) if batch_mode else [input]
+    outputs = {song: get_watch_output(song, output, batch_mode) for song in songs}
+    for song in songs:
+        rebuild_song(song, outputs[song], jobs, target_loudness, verbose)
+    
+    watcher = create_watcher(songs + ([input] if batch_mode else []), poll)
+    print(f"\nWatching {len(songs)} songs for changes{' by polling' if 'fd' not in watcher else ''}, ctrl+c to stop")
+    
+    changed = {}    # songs with changes not rebuilt yet, and when they last changed
+    try:
+        while True:
+            waits = [changed[song] + WATCH_DEBOUNCE - time.monotonic() for song in changed]
+            for folder in read_changes(watcher, max(0, min(waits)) if waits else None):
+                # new song folders in a batch, ones deleted or moved away stop being watched so they're watched again if they come back
+                if folder == input and batch_mode:
+                    songs = find_song_folders(input, output)
+                    for song in [song for song in outputs if song not in songs]:
+                        del outputs[song]
+                        changed.pop(song, None)
+                        remove_watch(watcher, song)
+                    for song in songs:
+                        if song not in outputs or song not in get_watched(watcher):
+                            outputs[song] = get_watch_output(song, output, batch_mode)
+                            add_watch(watcher, song)
+                            changed[song] = time.monotonic()
+                elif folder in outputs:
+                    changed[folder] = time.monotonic()
+            
+            for song, last_change in list(changed.items()):
+                if time.monotonic() - last_change >= WATCH_DEBOUNCE:
+                    del changed[song]
+                    rebuild_song(song, outputs[song], jobs, target_loudness, verbose)
+    except KeyboardInterrupt:
+        print("Stopped watching")
+    return 0
+
+# each song of a batch gets a folder named after its song folder, in an "out" folder in the root unless given one
+def get_batch_output_root(root, output_root=''):
+    return output_root or os.path.join(root, "out")
+
+# the output root is passed over when it's in the root
+def find_song_folders(root, output_root=''):
+    song_folders = [os.path.join(root, f) for f in os.listdir(root) if os.path.isdir(os.path.join(root, f)) and not f.startswith(".")]
+    return sorted(f for f in song_folders if not output_root or os.path.realpath(f) != os.path.realpath(output_root))
+
+def get_watch_output(song, output, batch_mode):
+    if batch_mode:
+        return os.path.join(output, os.path.basename(song))
+    return output
+
+# a failed build is reported and watching carries on, folders without any files of their own like an output folder are passed over
+def rebuild_song(song, output, jobs, target_loudness, verbose):
+    if not os.path.isdir(song) or not any(os.path.isfile(os.path.join(song, f)) for f in os.listdir(song)):
+        return
+    
+    start = time.time()
+    try:
+        main(song, output, jobs, target_loudness, verbose)
+        print(f"Built '{song}' in {time.time() - start:.2f}s")
+    except Exception as e:
+        print(f"FAILED '{song}': {type(e).__name__}: {e}")
+
+# WATCHERS
+# inotify on linux, otherwise every folder is listed every WATCH_POLL seconds and compared with the last listing
+# read_changes waits up to timeout seconds, or forever if it's None, and returns the folders something in changed in
+
+INOTIFY_EVENTS = 0x8 | 0x40 | 0x80 | 0x100 | 0x200 | 0x400     # close write, moved from, moved to, create, delete, delete self
+INOTIFY_HEADER = struct.Struct("iIII")                          # watch descriptor, mask, cookie, length of the name
+INOTIFY_IGNORED = 0x8000                                        # the watch was removed, by inotify_rm_watch or the folder being deleted
+
+def create_watcher(folders, poll=False):
+    watcher = {"folders": {}, "listings": {}}
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True) if not poll and sys.platform.startswith("linux") else None
+    if libc and hasattr(libc, "inotify_init1"):
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd >= 0:
+            watcher.update({"fd": fd, "libc": libc})
+    
+    for folder in folders:
+        add_watch(watcher, folder)
+    return watcher
+
+def add_watch(watcher, folder):
+    if "fd" in watcher:
+        wd = watcher["libc"].inotify_add_watch(watcher["fd"], os.fsencode(folder), INOTIFY_EVENTS)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"Can't watch '{folder}': {os.strerror(ctypes.get_errno())}")
+        watcher["folders"][wd] = folder
+    else:
+        watcher["listings"][folder] = list_folder(folder)
+
+def remove_watch(watcher, folder):
+    for wd in [wd for wd, watched in watcher["folders"].items() if watched == folder]:
+        watcher["libc"].inotify_rm_watch(watcher["fd"], wd)
+        del watcher["folders"][wd]
+    watcher["listings"].pop(folder, None)
+
+def get_watched(watcher):
+    return set(watcher["folders"].values()) if "fd" in watcher else set(watcher["listings"])
+
+def read_changes(watcher, timeout=None):
+    if "fd" not in watcher:
+        time.sleep(WATCH_POLL if timeout is None else min(timeout, WATCH_POLL))
+        changed = []
+        for folder, listing in watcher["listings"].items():
+            new_listing = list_folder(folder)
+            if new_listing != listing:
+                watcher["listings"][folder] = new_listing
+                changed += [folder]
+        return changed
+    
+    if not select.select([watcher["fd"]], [], [], timeout)[0]:
+        return []
     
-def generate(beat, audio, instruments, event, image, ini, input, output):
+    changed = set()
+    data = os.read(watcher["fd"], 65536)
+    offset = 0
+    while offset < len(data):
+        wd, mask, _, length = INOTIFY_HEADER.unpack_from(data, offset)
+        name = data[offset + INOTIFY_HEADER.size:offset + INOTIFY_HEADER.size + length].rstrip(b"\0").decode(errors="replace")
+        offset += INOTIFY_HEADER.size + length
+        if mask & INOTIFY_IGNORED:
+            watcher["folders"].pop(wd, None)
+        elif wd in watcher["folders"] and not is_ignored(name):
+            changed.add(watcher["folders"][wd])
+    return sorted(changed)
+
+# what's in a folder, by the size and modification time of each file, hidden and temporary files left out
+def list_folder(folder):
+    try:
+        return {entry.name: (entry.is_dir(), entry.stat().st_size, entry.stat().st_mtime_ns) for entry in os.scandir(folder) if not is_ignored(entry.name)}
+    except FileNotFoundError:
+        return {}
+
+# hidden files, including the temporary files outputs are saved through, and editor backups
+def is_ignored(name):
+    return name.startswith(".") or name.endswith("~")
+
+def generate(beat, audio, instruments, event, image, ini, input, output, jobs=None, target_loudness=TARGET_LOUDNESS, verbose=VERBOSE):
 
     # Generate output folder
     if (os.path.exists(output)):
@@ -88,127 +308,434 @@ def generate(beat, audio, instruments, event, image, ini, input, output):
     else:
         os.makedirs(output)
     
-    print("\nMIDI\t" + "="*DIV_NUM_LINES)
-    
-    # Generate BEAT.mid
-    if beat:
-        beat_midi_path = beat
-        if not beat.lower().endswith(".mid"):
-            audio_in = beat
-            if not beat.lower().endswith(".wav"):
-                audio_out = os.path.join(input, "BEAT.wav")
-                convert_audio(audio_in, audio_out)
-                audio_in = audio_out
-                
-            beat_midi_path = os.path.join(input, "BEAT.mid")
-            
-            print("Generating 'BEAT.mid'")
-            click_to_midi.main(audio_in, beat_midi_path, verbose=VERBOSE)
-    else:
+    manifest = load_manifest(output)
+    
+    # each stage is a function and the stages that have to finish before it starts
+    stages = {}
+    
+    if not beat:
         print("No beat file found")
     
-    # Generate notes.mid
+    # Generate notes.mid, with the tempo map of a beat audio file made along the way
     if instruments or event:
+        midi_file_paths = []
+        if event:
+            midi_file_paths += [event]
+        for instrument in instruments:
+            midi_file_paths += [instrument]
+        
         midi_output = os.path.join(output, "notes.mid")
-        if os.path.isfile(midi_output):
-            already_exists(midi_output)
-        else:
-            midi_file_paths = []
-            if beat:
-                midi_file_paths += [beat_midi_path]
-            if event:
-                midi_file_paths += [event]
-            for instrument in instruments:
-                midi_file_paths += [instrument]
-
-        charts_to_notes.main(midi_file_paths, midi_output)
+        stages["NOTES"] = (lambda: generate_notes(beat, midi_file_paths, midi_output, manifest, verbose), [])
     else:
         print("No midi instruments or events found")
     
-    
-    print("\nAUDIO\t" + "="*DIV_NUM_LINES)
     # Copy or convert song audio
     if audio:
-        audio_out = os.path.join(output, "song.ogg")
-        if os.path.isfile(audio_out):
-            already_exists(audio_out)
-        elif not audio.lower().endswith(".ogg"):
-            convert_audio(audio, audio_out, TARGET_LOUDNESS)
-        else:
-            print(f"Copying '{audio}' to '{audio_out}'")
-            shutil.copy(audio, audio_out)
+        stages["AUDIO"] = (lambda: generate_audio(audio, os.path.join(output, "song.ogg"), manifest, target_loudness), [])
     else:
         print("No audio file found")
     
     if image:
-        print("\nIMAGE\t" + "="*DIV_NUM_LINES)
-        for base in ["album", "background"]:
-            ext = os.path.splitext(image)[1]
-            image_out = os.path.join(output, f"{base}{ext}")
-            if os.path.isfile(image_out):
-                already_exists(image_out)
-            else:
-                print(f"Generating '{image_out}' from '{image}'")
-                if base == "album":
-                    create_album(image, image_out)
-                else:
-                    create_background(image, image_out)
+        image_outs = {base: os.path.join(output, f"{base}{os.path.splitext(image)[1]}") for base in ["album", "background"]}
+        stages["IMAGES"] = (lambda: generate_images(image, image_outs, manifest), [])
     else:
         print("No image file found")
-        
-    print("\nINI\t" + "="*DIV_NUM_LINES)
+    
     if not ini:
         ini = os.path.join(os.path.dirname(os.path.realpath(__file__)), "template.ini")
-    ini_out = os.path.join(output, "song.ini")
-    if os.path.isfile(ini_out):
-        already_exists(ini_out)
+    stages["INI"] = (lambda: copy_file(ini, os.path.join(output, "song.ini"), manifest), [])
+    
+    run_stages(stages, jobs)
+
+# runs every stage as soon as the stages it needs are done, stages that don't need each other run at the same time
+# what a stage prints is held back and shown in one go when it finishes, and the first failure stops any more stages starting
+def run_stages(stages, jobs=None):
+    finished = set()
+    failure = None
+    
+    stdout = sys.stdout
+    sys.stdout = StageOutput(stdout)
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            running = {}
+            while True:
+                if not failure:
+                    for name, (function, needs) in stages.items():
+                        if name not in finished and name not in running.values() and all(need in finished for need in needs):
+                            running[executor.submit(run_stage, function)] = name
+                if not running:
+                    break
+                
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    output, error = future.result()
+                    
+                    print(f"\n{name}\t" + "="*DIV_NUM_LINES, file=stdout)
+                    print(output, end="", file=stdout)
+                    if error:
+                        print(f"FAILED: {type(error).__name__}: {error}", file=stdout)
+                        failure = failure or (name, error)
+                    else:
+                        finished.add(name)
+    finally:
+        sys.stdout = stdout
+    
+    if failure:
+        name, error = failure
+        raise Exception(f"{name} stage failed: {error}") from error
+
+def run_stage(function):
+    sys.stdout.local.buffer = io.StringIO()
+    try:
+        function()
+        error = None
+    except Exception as e:
+        error = e
+    output = sys.stdout.local.buffer.getvalue()
+    del sys.stdout.local.buffer
+    return output, error
+
+# stands in for stdout while stages run, anything a stage thread prints goes to that thread's buffer
+class StageOutput:
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+    
+    def write(self, text):
+        return getattr(self.local, "buffer", self.stream).write(text)
+    
+    def flush(self):
+        getattr(self.local, "buffer", self.stream).flush()
+
+# STAGES
+# each skips its output when it was last built from the same inputs and parameters
+
+# a beat audio file is decoded and turned into a tempo map in memory, nothing is written next to it
+def generate_notes(beat, midi_file_paths, midi_output, manifest, verbose=VERBOSE):
+    in_files = ([beat] if beat else []) + midi_file_paths
+    beat_is_audio = beat and not beat.lower().endswith(".mid")
+    
+    # charts_to_notes picks each file's part by its name, so renaming one changes notes.mid too
+    names = [os.path.basename(path) for path in in_files]
+    if beat_is_audio:
+        key = get_build_key(manifest, in_files + list(CLICK_PATHS.values()), names, charts_to_notes.TICKS_PER_BEAT, click_to_midi.TICKS_PER_BEAT, click_to_midi.BPM_TOL)
     else:
-        print(f"Copying '{ini}' to '{ini_out}'")
-        shutil.copy(ini, ini_out)
+        key = get_build_key(manifest, in_files, names, charts_to_notes.TICKS_PER_BEAT)
+    if is_up_to_date(manifest, midi_output, key):
+        return
+    
+    if beat_is_audio:
+        with profiler.stage("beat decode"):
+            audio, sample_rate = decode_audio(beat)
         
+        print("Generating 'BEAT' tempo map")
+        with profiler.stage("beat midi"):
+            in_files[0] = ("BEAT", get_click_converter(sample_rate, verbose).convert_tempo_map(audio, sample_rate))
+    
+    with profiler.stage("chart merge"):
+        charts_to_notes.main(in_files, midi_output)
+    record_build(manifest, midi_output, key)
+
+def generate_audio(audio, audio_out, manifest, target_loudness=TARGET_LOUDNESS):
+    key = get_build_key(manifest, [audio], target_loudness)
+    if is_up_to_date(manifest, audio_out, key):
+        return
+    
+    if not audio.lower().endswith(".ogg") or target_loudness != None:
+        with profiler.stage("audio transcode"):
+            convert_audio(audio, audio_out, target_loudness)
+    else:
+        print(f"Copying '{audio}' to '{audio_out}'")
+        with profiler.stage("audio copy"):
+            shutil.copy(audio, audio_out)
+    record_build(manifest, audio_out, key)
+
+# the album and background are rendered from a single decode of the cover, only as big as the outputs out of date need
+def generate_images(image, image_outs, manifest):
+    keys = {base: get_build_key(manifest, [image], base, MAX_RESOLUTION, BLUR_RADIUS) for base in image_outs}
+    bases = [base for base, image_out in image_outs.items() if not is_up_to_date(manifest, image_out, keys[base])]
+    if not bases:
+        return
+    
+    with profiler.stage("cover decode"):
+        cover, full_size = load_cover(image, bases)
+    
+    for base in bases:
+        print(f"Generating '{image_outs[base]}' from '{image}'")
+        with profiler.stage(f"{base} render"):
+            if base == "album":
+                create_album(cover, full_size, image_outs[base])
+            else:
+                create_background(cover, full_size, image_outs[base])
+        record_build(manifest, image_outs[base], keys[base])
+
+def copy_file(f_in, f_out, manifest):
+    key = get_build_key(manifest, [f_in])
+    if is_up_to_date(manifest, f_out, key):
+        return
     
-def convert_audio(f_in, f_out, target_amplitude=None):
+    print(f"Copying '{f_in}' to '{f_out}'")
+    shutil.copy(f_in, f_out)
+    record_build(manifest, f_out, key)
+
+# MANIFEST
+# "builds" has the key each output was built with, by file name
+# "files" has the size, modification time and hash of every input, so unchanged files aren't read again
+
+def load_manifest(output):
+    manifest = {"builds": {}, "files": {}}
+    manifest_path = os.path.join(output, MANIFEST_NAME)
+    if os.path.isfile(manifest_path):
+        try:
+            with open(manifest_path) as f:
+                manifest.update(json.load(f))
+        except ValueError:
+            pass    # a damaged manifest only means building everything again
+    
+    manifest["path"] = manifest_path
+    manifest["lock"] = threading.Lock()
+    return manifest
+
+def save_manifest(manifest):
+    with atomic.replacing(manifest["path"]) as temp_path:
+        with open(temp_path, "w") as f:
+            json.dump({"builds": manifest["builds"], "files": manifest["files"]}, f, indent=4)
+
+# a hash of everything an output is built from, the contents of its input files and the parameters of its stage
+def get_build_key(manifest, paths, *parameters):
+    key = hashlib.sha256(repr((BUILD_VERSION,) + parameters).encode())
+    for path in paths:
+        key.update(hash_file(manifest, path).encode())
+    return key.hexdigest()
+
+def hash_file(manifest, path):
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    with manifest["lock"]:
+        cached = manifest["files"].get(path)
+    if cached and cached[:2] == [stat.st_size, stat.st_mtime_ns]:
+        return cached[2]
+    
+    file_hash = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            file_hash.update(block)
+    
+    with manifest["lock"]:
+        manifest["files"][path] = [stat.st_size, stat.st_mtime_ns, file_hash.hexdigest()]
+    return file_hash.hexdigest()
+
+def is_up_to_date(manifest, path, key):
+    with manifest["lock"]:
+        up_to_date = os.path.isfile(path) and manifest["builds"].get(os.path.basename(path)) == key
+    if up_to_date:
+        print(f"'{path}' is up to date")
+    return up_to_date
+
+def record_build(manifest, path, key):
+    with manifest["lock"]:
+        manifest["builds"][os.path.basename(path)] = key
+        save_manifest(manifest)
+    
+# samples as frames of channels and the sample rate, through ffmpeg if libsndfile can't read it
+def get_click_converter(sample_rate, verbose=VERBOSE):
+    with CLICK_CONVERTERS_LOCK:
+        if (sample_rate, verbose) not in CLICK_CONVERTERS:
+            CLICK_CONVERTERS[(sample_rate, verbose)] = click_to_midi.ClickConverter(sample_rate, verbose=verbose, **CLICK_PATHS)
+        return CLICK_CONVERTERS[(sample_rate, verbose)]
+
+def decode_audio(path):
+    try:
+        return sf.read(path, always_2d=True)
+    except RuntimeError:
+        segment = AudioSegment.from_file(path)
+        samples = np.array(segment.get_array_of_samples()).reshape(-1, segment.channels)
+        return samples / 2**(8 * segment.sample_width - 1), segment.frame_rate
+
+# decodes and encodes a block at a time so memory stays flat however long the audio is
+# with a target loudness, a first pass measures the integrated loudness while caching the decoded blocks to a temporary file,
+# then a second pass turns them down to the target from the cache, audio is never turned up
+def convert_audio(f_in, f_out, target_loudness=None):
     print(f"Converting '{f_in}' to '{f_out}'")
-    audio = AudioSegment.from_file(f_in)
-    if target_amplitude != None:
-        dB_change = min(0, target_amplitude - audio.dBFS)
-        print(dB_change)
-        audio = audio.apply_gain(dB_change)
+    try:
+        info = sf.info(f_in)
+    except RuntimeError:
+        # formats libsndfile can't read are decoded by ffmpeg first
+        with tempfile.TemporaryDirectory() as temp_dir:
+            decoded = os.path.join(temp_dir, "decoded.wav")
+            AudioSegment.from_file(f_in).export(decoded, format="wav")
+            return convert_audio(decoded, f_out, target_loudness)
+    
+    # the extension picks the format
+    with atomic.replacing(f_out) as temp_path:
+        with sf.SoundFile(temp_path, "w", info.samplerate, info.channels) as out:
+            blocks = sf.blocks(f_in, blocksize=TRANSCODE_BLOCK, dtype="float32", always_2d=True)
+            if target_loudness == None:
+                for block in blocks:
+                    out.write(block)
+            else:
+                with tempfile.TemporaryFile() as cache:
+                    meter = create_loudness_meter(info.samplerate, info.channels)
+                    for block in blocks:
+                        measure_loudness(meter, block)
+                        cache.write(block.tobytes())
+                    
+                    loudness = get_integrated_loudness(meter)
+                    dB_change = min(0, target_loudness - loudness) if np.isfinite(loudness) else 0
+                    print(f"{loudness:.1f} LUFS, {dB_change:.1f}dB change")
+                    gain = 10**(dB_change / 20)
+                    
+                    cache.seek(0)
+                    for data in iter(lambda: cache.read(TRANSCODE_BLOCK * info.channels * 4), b""):
+                        out.write(np.frombuffer(data, dtype=np.float32).reshape(-1, info.channels) * gain)
+
+# LOUDNESS
+# integrated loudness as in BS.1770 and pyloudnorm, worked out a block at a time
+# the k-weighting filters carry their state across blocks, and the energy is summed up to every gating block edge as it's passed
+
+def create_loudness_meter(rate, channels):
+    filters = [get_biquad(rate, *stage) for stage in K_WEIGHTING]
+    return {
+        "rate": rate,
+        "filters": filters,
+        "filter_states": [np.zeros((2, channels)) for _ in filters],
+        "position": 0,
+        "energy": np.zeros(channels),           # sum of squares of all the filtered audio so far
+        "lower_energies": [],                   # the energy up to the start of each gating block
+        "upper_energies": [],                   # and up to its end
+    }
 
-    audio.export(f_out)
+# coefficients of a high shelf, or a high pass when it has no gain, from the audio eq cookbook like pyloudnorm
+def get_biquad(rate, gain, q, frequency):
+    A = 10**(gain/40.0)
+    w0 = 2.0 * np.pi * (frequency / rate)
+    alpha = np.sin(w0) / (2.0 * q)
     
-MAX_RESOLUTION = (2560, 1440)
+    if gain:
+        b = [A * ((A+1) + (A-1) * np.cos(w0) + 2 * np.sqrt(A) * alpha),
+             -2 * A * ((A-1) + (A+1) * np.cos(w0)),
+             A * ((A+1) + (A-1) * np.cos(w0) - 2 * np.sqrt(A) * alpha)]
+        a = [(A+1) - (A-1) * np.cos(w0) + 2 * np.sqrt(A) * alpha,
+             2 * ((A-1) - (A+1) * np.cos(w0)),
+             (A+1) - (A-1) * np.cos(w0) - 2 * np.sqrt(A) * alpha]
+    else:
+        b = [(1 + np.cos(w0))/2, -(1 + np.cos(w0)), (1 + np.cos(w0))/2]
+        a = [1 + alpha, -2 * np.cos(w0), 1 - alpha]
+    return np.array(b) / a[0], np.array(a) / a[0]
+
+def get_gate_bounds(rate, j):
+    step = 1.0 - 0.75
+    return int(GATE_LENGTH * (j * step) * rate), int(GATE_LENGTH * (j * step + 1) * rate)
 
-def create_album(image, image_out):
-    image = Image.open(image)
+def measure_loudness(meter, block):
+    filtered = block.astype(np.float64)
+    for i, (b, a) in enumerate(meter["filters"]):
+        filtered, meter["filter_states"][i] = scipy.signal.lfilter(b, a, filtered, axis=0, zi=meter["filter_states"][i])
     
-    if(image.width > min(MAX_RESOLUTION) or image.height > min(MAX_RESOLUTION)):
-        image = image.resize((min(MAX_RESOLUTION), min(MAX_RESOLUTION)))
-    image.save(image_out, 'png', quality=80)
+    start = meter["position"]
+    energies = meter["energy"] + np.cumsum(np.square(filtered), axis=0)
+    for bound, edges in enumerate([meter["lower_energies"], meter["upper_energies"]]):
+        while get_gate_bounds(meter["rate"], len(edges))[bound] <= start + len(block):
+            edge = get_gate_bounds(meter["rate"], len(edges))[bound]
+            edges += [energies[edge - start - 1].copy() if edge > start else meter["energy"].copy()]
     
-def create_background(image, image_out):
-    image = Image.open(image)
+    meter["position"] += len(block)
+    meter["energy"] = energies[-1] if len(block) else meter["energy"]
+
+def get_integrated_loudness(meter):
+    rate = meter["rate"]
+    num_blocks = int(np.round((meter["position"] / rate - GATE_LENGTH) / (GATE_LENGTH * 0.25))) + 1
+    if meter["position"] < GATE_LENGTH * rate or num_blocks < 1:
+        return -np.inf
+    
+    # gating blocks past the end only have the audio up to the end
+    lower = np.array(meter["lower_energies"][:num_blocks] + [meter["energy"]] * (num_blocks - len(meter["lower_energies"])))
+    upper = np.array(meter["upper_energies"][:num_blocks] + [meter["energy"]] * (num_blocks - len(meter["upper_energies"])))
+    z = (upper - lower) / (GATE_LENGTH * rate)
+    
+    weights = np.array([CHANNEL_WEIGHTS[i] if i < len(CHANNEL_WEIGHTS) else 1.0 for i in range(z.shape[1])])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        block_loudness = -0.691 + 10 * np.log10(z @ weights)
+        
+        # absolute gate at -70 LUFS, then a relative gate 10 LU under what passes that
+        gated = block_loudness >= -70.0
+        relative_gate = -0.691 + 10 * np.log10(np.mean(z[gated], axis=0) @ weights) - 10.0
+        gated = (block_loudness > relative_gate) & (block_loudness > -70.0)
+        return -0.691 + 10 * np.log10(np.nan_to_num(np.mean(z[gated], axis=0)) @ weights)
     
-    aspect_ratio = image.width / image.height
+MAX_RESOLUTION = (2560, 1440)
+BLUR_RADIUS = 15            # of the background blur, in pixels of a background as wide as the cover
+BLUR_WORKING_RADIUS = 4     # the blur is done small enough to be this many pixels, then scaled up, which looks the same
+
+def get_album_size(full_size):
+    if(full_size[0] > min(MAX_RESOLUTION) or full_size[1] > min(MAX_RESOLUTION)):
+        return (min(MAX_RESOLUTION), min(MAX_RESOLUTION))
+    return full_size
+
+# the 16:9 background around a cover of full_size, and the size it's rendered at
+def get_background_size(full_size):
+    aspect_ratio = full_size[0] / full_size[1]
     aspect_ratio_out_w = 16
     aspect_ratio_out_h = 9
     
     if aspect_ratio > 1:
-        width = image.width
-        height = int(image.width * (aspect_ratio_out_h/aspect_ratio_out_w))
+        width = full_size[0]
+        height = int(full_size[0] * (aspect_ratio_out_h/aspect_ratio_out_w))
     else:
-        width = int(image.height * (aspect_ratio_out_w/aspect_ratio_out_h))
-        height = image.height
+        width = int(full_size[1] * (aspect_ratio_out_w/aspect_ratio_out_h))
+        height = full_size[1]
+    
+    if(width > MAX_RESOLUTION[0]):
+        return (width, height), MAX_RESOLUTION
+    return (width, height), (width, height)
+
+# decodes the cover at the smallest size still as big as any of the outputs of bases are made from
+# jpegs are decoded straight to a smaller size, anything else is decoded in full and reduced
+# returns it along with the cover's full size, which the outputs are laid out by
+def load_cover(path, bases):
+    image = Image.open(path)
+    full_size = image.size
+    
+    # the album is stretched to its size, and the background stretched to a square as wide as it
+    needed = [get_album_size(full_size) if base == "album" else (get_background_size(full_size)[1][0],) * 2 for base in bases]
+    needed = (max(size[0] for size in needed), max(size[1] for size in needed))
+    
+    if image.format == "JPEG":
+        image.draft(image.mode, needed)
+    image.load()
+    
+    factor = min(image.width // needed[0], image.height // needed[1])
+    if factor > 1 and image.mode not in ["P", "1"]:
+        image = image.reduce(factor)
+    return image, full_size
+
+def create_album(cover, full_size, image_out):
+    size = get_album_size(full_size)
+    if cover.size != size:
+        cover = cover.resize(size)
+    cover.save(image_out, 'png', quality=80)
     
-    resized_image = image.resize((width, width))
+# a blurred stretch of the cover behind a smaller copy of it, laid out at the cover's full size but drawn straight at the output size
+def create_background(cover, full_size, image_out):
+    (width, height), (out_width, out_height) = get_background_size(full_size)
+    scale = out_width / width
     
-    left = (resized_image.width - width) / 2
-    top = (resized_image.height - height) / 2
-    right = left + width
-    bottom = top + height
+    # blurred at a fraction of the output size, then scaled up to it
+    working_scale = min(1, BLUR_WORKING_RADIUS / (BLUR_RADIUS * scale))
+    working_width = max(1, round(out_width * working_scale))
+    working_height = max(1, round(out_height * working_scale))
+    
+    resized_image = cover.resize((working_width, working_width))
+    
+    left = (resized_image.width - working_width) / 2
+    top = (resized_image.height - working_height) / 2
+    right = left + working_width
+    bottom = top + working_height
     cropped_image = resized_image.crop((left, top, right, bottom))
 
-    blurred_image = cropped_image.filter(ImageFilter.GaussianBlur(radius=15))
+    blurred_image = cropped_image.filter(ImageFilter.GaussianBlur(radius=BLUR_RADIUS * scale * working_scale))
+    blurred_image = blurred_image.resize((out_width, out_height))
 
     # Cover placement
     
@@ -224,9 +751,9 @@ def create_background(image, image_out):
     # pos_y = int((height - cover_image.height) / 2) - int(height*0.1)
     
     # ^^ but smaller
-    cover_image = image.resize((int(image.width*0.5), int(image.height*0.5)))
-    pos_x = int((width - cover_image.width) / 2)
-    pos_y = int((height - cover_image.height) / 2) - int(height*0.2)
+    cover_image = cover.resize((int(full_size[0]*0.5*scale), int(full_size[1]*0.5*scale)))
+    pos_x = int((out_width - cover_image.width) / 2)
+    pos_y = int((out_height - cover_image.height) / 2) - int(out_height*0.2)
     
     # # Place upper right middle    + rep RecursiveGoon for the inspiration
     # cover_image = image.resize((int(image.width*0.5), int(image.height*0.5)))
@@ -234,7 +761,7 @@ def create_background(image, image_out):
     # pos_y = int(cover_image.height * 0.2)
     
     # Border
-    border_size = int(width * 0.0015)
+    border_size = int(out_width * 0.0015)
     draw = ImageDraw.Draw(blurred_image)
     x1 = pos_x - border_size
     x2 = pos_x + cover_image.width + border_size
@@ -245,25 +772,37 @@ def create_background(image, image_out):
     draw.rectangle([x1, y1, x2, y2], fill=color)
     
     blurred_image.paste(cover_image, (pos_x, pos_y))
-    
-    if(blurred_image.width > MAX_RESOLUTION[0]):
-        blurred_image = blurred_image.resize(MAX_RESOLUTION)
     blurred_image.save(image_out, 'png', quality=80)
 
-def already_exists(path):
-    print(f"'{path}' already exists")
-
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='A tool for generating song folders compatable with clone hero')
-    parser.add_argument('-i', '--input', required=True, help='An input folder path')
-    parser.add_argument('-o', '--output', required=False, default='', help='An output folder path')
+    parser.add_argument('-i', '--input', required=True, help='An input folder path, or a folder of input folders with --batch')
+    parser.add_argument('-o', '--output', required=False, default='', help='An output folder path, for a batch each song gets a folder in it, which defaults to an out folder in the input folder')
+    parser.add_argument('-b', '--batch', action='store_true', help='Build every song folder in the input folder, carrying on from an interrupted batch')
+    parser.add_argument('--fresh', action='store_true', help='Start a batch from scratch rather than carrying on')
+    parser.add_argument('-w', '--watch', action='store_true', help='Keep running and rebuild a song whenever its source files change, with --batch every song in the input folder')
+    parser.add_argument('--poll', action='store_true', help='Watch by checking the folders for changes every so often rather than with inotify, for network drives')
     parser.add_argument('-v', '--verbose', action='store_true', help='Verbose output')
+    parser.add_argument('-l', '--loudness', type=float, default=None, help='Integrated loudness in LUFS to turn song audio down to, it is left alone otherwise')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='Number of stages to run at once, or of songs to build at once for a batch. Defaults to the number of cores')
+    parser.add_argument('--profile', nargs='?', const='', default=None, metavar='JSON', help='Print the time and peak memory of each stage with some counters, and optionally save them to a json file')
 
     args = vars(parser.parse_args())
-    if(args['verbose']):
-        VERBOSE = True
+    if args['profile'] is not None:
+        profiler.enable()
     
-    sys.exit(main(
-        args['input'],
-        args['output']
-    ))
+    if args['watch']:
+        result = watch(args['input'], args['output'], args['batch'], args['jobs'], args['poll'], args['loudness'], args['verbose'])
+    elif args['batch']:
+        result = batch(args['input'], args['output'], args['jobs'], args['fresh'], args['loudness'], args['verbose'])
+    else:
+        result = main(
+            args['input'],
+            args['output'],
+            args['jobs'],
+            args['loudness'],
+            args['verbose'],
+        )
+    if args['profile'] is not None:
+        profiler.report(args['profile'])
+    sys.exit(result)
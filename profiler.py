@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+import json
+import time
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+ENABLED = False
+STAGES = {}     # wall time and peak memory of each stage, in the order they first ran
+COUNTERS = {}
+LOCK = threading.Lock()
+LOCAL = threading.local()   # each thread's [memory at start, peak memory, name] of the stages it's running, innermost last
+RUNNING = 0                 # stages running across all threads
+
+def enable():
+    global ENABLED
+    ENABLED = True
+    tracemalloc.start()
+
+# times a block of code and records the most memory allocated in it above what was in use when it began
+# stages can nest, a stage run more than once adds up its time
+# memory is traced for the whole process, so stages running at the same time on other threads share their peaks
+@contextmanager
+def stage(name):
+    global RUNNING
+    if not ENABLED:
+        yield
+        return
+
+    running = LOCAL.__dict__.setdefault("running", [])
+    with LOCK:
+        current, peak = tracemalloc.get_traced_memory()
+        if running:
+            running[-1][1] = max(running[-1][1], peak)
+        if RUNNING == len(running):
+            tracemalloc.reset_peak()
+        record = STAGES.setdefault(name, {"parent": running[-1][2] if running else None, "calls": 0, "seconds": 0.0, "peak_bytes": 0})
+        running.append([current, current, name])
+        RUNNING += 1
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        with LOCK:
+            start_memory, peak, _ = running.pop()
+            RUNNING -= 1
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            if running:
+                running[-1][1] = max(running[-1][1], peak)
+
+            record["calls"] += 1
+            record["seconds"] += seconds
+            record["peak_bytes"] = max(record["peak_bytes"], peak - start_memory)
+
+# each stage followed by the stages run inside it
+def print_stages(parent=None, depth=0):
+    for name, record in STAGES.items():
+        if record["parent"] == parent:
+            print(f"{'  ' * depth + name:<36}{record['calls']:>7}{record['seconds']:>10.3f}{record['peak_bytes'] / 2**20:>10.1f}")
+            print_stages(name, depth + 1)
+
+def count(name, amount=1):
+    if ENABLED:
+        with LOCK:
+            COUNTERS[name] = COUNTERS.get(name, 0) + amount
+
+def report(json_path=''):
+    print(f"\n{'stage':<36}{'calls':>7}{'seconds':>10}{'peak MB':>10}")
+    print_stages()
+
+    if COUNTERS:
+        print(f"\n{'counter':<36}{'count':>27}")
+        for name, value in COUNTERS.items():
+            print(f"{name:<36}{value:>27,}")
+
+    if json_path:
+        with open(json_path, "w") as f:
+            json.dump({"stages": STAGES, "counters": COUNTERS}, f, indent=4)
+        print(f"\nProfile written to '{json_path}'")
@@ -0,0 +1,21 @@
+#!/usr/bin/env python
+
+import struct
+
+# standard midi file pieces shared by the writers that skip building mido messages, byte for byte what mido saves
+
+# the header chunk of a type 1 file
+def write_header(num_tracks, ticks_per_beat):
+    return struct.pack(">4sLHHH", b"MThd", 6, 1, num_tracks, ticks_per_beat)
+
+def write_track_chunk(data):
+    return struct.pack(">4sL", b"MTrk", len(data)) + bytes(data)
+
+# midi variable length quantity, 7 bits a byte most significant first
+def write_var_length(value):
+    var_bytes = [value & 0x7F]
+    value >>= 7
+    while value:
+        var_bytes.insert(0, (value & 0x7F) | 0x80)
+        value >>= 7
+    return bytes(var_bytes)